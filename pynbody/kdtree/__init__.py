@@ -410,9 +410,9 @@ class KDTree:
         self.set_array_ref("qty_sm", output)
 
         logger.info("Smoothing array with %d nearest neighbours" % nsmooth)
-        start = time.time()
+        start = time.perf_counter()
         self.populate("qty_mean", nsmooth)
-        end = time.time()
+        end = time.perf_counter()
 
         logger.info("SPH smooth done in %5.3g s" % (end - start))
 
@@ -460,9 +460,9 @@ class KDTree:
         self.set_array_ref("qty_sm", output)
 
         logger.info("Getting dispersion of array with %d nearest neighbours" % nsmooth)
-        start = time.time()
+        start = time.perf_counter()
         self.populate("qty_disp", nsmooth)
-        end = time.time()
+        end = time.perf_counter()
 
         logger.info("SPH dispersion done in %5.3g s" % (end - start))
 
@@ -486,9 +486,9 @@ class KDTree:
         self.set_array_ref("qty_sm", output)
 
         logger.info("Getting %s of array with %d nearest neighbours" % (op_label, nsmooth))
-        start = time.time()
+        start = time.perf_counter()
         self.populate("qty_%s" % op, nsmooth)
-        end = time.time()
+        end = time.perf_counter()
 
         logger.info(f"SPH {op_label} done in {end - start:5.3g} s")
 
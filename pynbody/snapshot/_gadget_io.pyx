@@ -0,0 +1,122 @@
+"""Cython helpers for reading old-style (non-HDF5) gadget binary files."""
+
+cimport cython
+from libc.stdint cimport int64_t, uint32_t
+from libc.string cimport memcpy
+
+
+cdef inline uint32_t _read_uint32(const unsigned char[::1] buf, Py_ssize_t offset, bint swap) noexcept:
+    cdef uint32_t value
+    memcpy(&value, &buf[offset], 4)
+    if swap:
+        value = (((value & 0xff) << 24) | ((value & 0xff00) << 8) |
+                 ((value >> 8) & 0xff00) | ((value >> 24) & 0xff))
+    return value
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def scan_blocks(const unsigned char[::1] buf, Py_ssize_t offset, bint format2, bint swap,
+                list block_names, Py_ssize_t first_name, int64_t t_part, str filename):
+    """Walk the Fortran records of a gadget file, starting at the given offset.
+
+    Parameters
+    ----------
+
+    buf : buffer
+        The contents of the file, typically a read-only memory map.
+    offset : int
+        The offset of the first record to scan (i.e. the record following the HEAD block).
+    format2 : bool
+        Whether each record is preceded by a format-2 block name record.
+    swap : bool
+        Whether the record markers are byte-swapped relative to the native byte order.
+    block_names : list of bytes
+        For format-1 files, the names to assign to successive records. Unused for format 2.
+    first_name : int
+        The index in block_names of the name to assign to the first record scanned.
+    t_part : int
+        The total number of particles in the file, used to infer the per-particle length of
+        the POS, VEL and ID blocks.
+    filename : str
+        The name of the file being scanned, used in error messages.
+
+    Returns
+    -------
+
+    blocks : list of tuple
+        A (name, start, length, partlen) tuple for each record. partlen is zero unless it was inferred for a
+        POS, VEL or ID block.
+    n_fallback_names : int
+        The number of format-1 records which were given a fallback name, because block_names ran out.
+    """
+    cdef Py_ssize_t buf_len = buf.shape[0]
+    cdef int64_t length, partlen, extra_len
+    cdef uint32_t record_size
+    cdef Py_ssize_t name_index = first_name, n_fallback_names = 0
+    cdef list blocks = []
+
+    while True:
+        if format2:
+            # If we have run out of file, we just stop scanning
+            if offset + 5 * 4 > buf_len:
+                break
+            if (_read_uint32(buf, offset, swap) != 8 or _read_uint32(buf, offset + 12, swap) != 8 or
+                    <int64_t> _read_uint32(buf, offset + 16, swap) != <int64_t> _read_uint32(buf, offset + 8, swap) - 8):
+                raise OSError("Corrupt header record in %s. Possibly incorrect file format" % filename)
+            name = bytes(buf[offset + 4:offset + 8])
+            # Don't include the two "record_size" indicators in the total length count
+            length = <int64_t> _read_uint32(buf, offset + 8, swap) - 8
+            offset += 5 * 4
+        else:
+            if offset + 4 > buf_len:
+                break
+            length = _read_uint32(buf, offset, swap)
+            if name_index < len(block_names):
+                name = block_names[name_index]
+                name_index += 1
+            else:
+                name = ("UNK" + str(n_fallback_names)).encode('utf-8')
+                n_fallback_names += 1
+            offset += 4
+
+        if length == 0:
+            break
+
+        if name == b"HEAD":
+            raise OSError("Encountered a second HEAD block in %s" % filename)
+
+        # Set the partlen for blocks where the type can be inferred from the name
+        if name == b"POS " or name == b"VEL ":
+            partlen = 24 if length == t_part * 24 else 12
+        elif name == b"ID  ":
+            partlen = 4 if length == t_part * 4 else 8
+        else:
+            partlen = 0
+
+        start = offset
+
+        # Check for the case where the record size overflows an int.
+        # If this is true, we can't get record size from the length and we just have to guess
+        # At least the record sizes at either end should be consistently wrong.
+        # Better hope this only happens for blocks where all particles are
+        # present.
+        extra_len = t_part * partlen
+        if extra_len >= 2 ** 32:
+            offset += extra_len
+        else:
+            offset += length
+
+        if offset + 4 > buf_len:
+            raise OSError("Could not read footer for block %r in %s" % (name, filename))
+        record_size = _read_uint32(buf, offset, swap)
+        offset += 4
+        if record_size != length:
+            raise OSError("Corrupt record in %s footer for block %r" % (filename, name))
+
+        if extra_len >= 2 ** 32:
+            length = extra_len
+
+        blocks.append((name, start, length, partlen))
+
+    return blocks, n_fallback_names
@@ -12,10 +12,14 @@ Very old gadget-1 style files have a fixed block order, which is specified in th
 """
 
 
+import concurrent.futures
 import configparser
+import contextlib
 import copy
 import errno
-import itertools
+import functools
+import mmap
+import operator
 import os
 import pathlib
 import struct
@@ -25,7 +29,7 @@ import warnings
 import numpy as np
 
 from .. import array, config_parser, family, units
-from . import SimSnap, namemapper
+from . import SimSnap, _gadget_io, namemapper
 
 # This is set here and not in a config file because too many things break
 # if it is not 6
@@ -45,9 +49,46 @@ for name, gtypes in config_parser.items('gadget-type-mapping'):
     except configparser.NoOptionError:
         pass
 
+# When a family spans several gadget types, particles written from pynbody are all given the first of them
+_first_type_map = {fam: int(gtypes.min()) for fam, gtypes in _type_map.items()}
+
+_direct_io = config_parser.getboolean('gadget-io', 'direct-io') and hasattr(os, 'O_DIRECT')
+_direct_io_min_bytes = int(config_parser.get('gadget-io', 'direct-io-min-bytes'))
+_parallel_read = int(config_parser.get('gadget-io', 'parallel-read'))
+_mmap_arrays = config_parser.getboolean('gadget-io', 'mmap-arrays')
+
 _name_map, _rev_name_map = namemapper.setup_name_maps(
     'gadget-name-mapping', gadget_blocks=True)
-_translate_array_name = namemapper.name_map_function(_name_map, _rev_name_map)
+# The name maps are only ever extended (by GadgetSnap.__init__, which clears the cache when it does so),
+# so translations can safely be memoised
+_translate_array_name = functools.lru_cache(maxsize=None)(
+    namemapper.name_map_function(_name_map, _rev_name_map))
+
+# Precompiled struct layouts, keyed by the endian character used in the format string (an
+# empty string is native byte order, as used by headers constructed in memory).
+# The header layout is 256 bytes including padding; the padding is omitted when serialising
+# so that any extra data stored there by other codes is not overwritten.
+_ENDIANS = ("", "=", "<", ">")
+_HEADER_STRUCTS_NOPAD = {e: struct.Struct(e + "IIIIIIddddddddiiIIIIIIiiddddiiIIIIIIiiif") for e in _ENDIANS}
+_U32_STRUCTS = {e: struct.Struct(e + "I") for e in _ENDIANS}
+_BLOCK_HEAD_STRUCTS = {e: struct.Struct(e + "I4sIII") for e in _ENDIANS}
+_BLOCK_HEAD_WRITE_STRUCTS = {e: struct.Struct(e + "I4sII") for e in _ENDIANS}
+
+# Possible values of the first uint32 of a gadget file: the size of the format-2 name record or the
+# format-1 header record, natively or byte-swapped
+_MAGIC_NUMBERS = frozenset((8, 134217728, 65536, 256))
+
+# The header layout as a NumPy record, for reading straight into arrays; the byte order
+# of a file is applied with newbyteorder
+_HEADER_DTYPE = np.dtype([('npart', 'u4', N_TYPE), ('mass', 'f8', N_TYPE), ('time', 'f8'), ('redshift', 'f8'),
+                          ('flag_sfr', 'i4'), ('flag_feedback', 'i4'), ('npartTotal', 'u4', N_TYPE),
+                          ('flag_cooling', 'i4'), ('num_files', 'i4'), ('BoxSize', 'f8'), ('Omega0', 'f8'),
+                          ('OmegaLambda', 'f8'), ('HubbleParam', 'f8'), ('flag_stellarage', 'i4'),
+                          ('flag_metals', 'i4'), ('NallHW', 'u4', N_TYPE), ('flag_entropy_instead_u', 'i4'),
+                          ('flag_doubleprecision', 'i4'), ('flag_ic_info', 'i4'), ('lpt_scalingfactor', 'f4'),
+                          ('fill', 'V48')])
+if _HEADER_DTYPE.itemsize != 256 or _HEADER_STRUCTS_NOPAD["="].size != 256 - 48:
+    raise Exception("There is a bug in gadget.py; the header format string is not 256 bytes")
 
 
 def _to_raw(s):
@@ -69,6 +110,97 @@ def gadget_type(fam):
         return _type_map[fam]
 
 
+def _particle_subset_table(npart):
+    """Map the total particle count of each subset of gadget types onto a boolean mask of those types.
+
+    Where several subsets share the same total, the subset with the fewest types wins, followed by the one
+    with the lowest type indices."""
+    masks = sorted(range(1, 1 << N_TYPE),
+                   key=lambda m: (bin(m).count("1"), [i for i in range(N_TYPE) if (m >> i) & 1]))
+    npart = np.asarray(npart, dtype=np.int64)
+    table = {}
+    for mask in masks:
+        p_types = np.array([(mask >> i) & 1 for i in range(N_TYPE)], dtype=bool)
+        table.setdefault(int(npart[p_types].sum()), p_types)
+    return table
+
+
+def _read_direct(filename, offset, n_bytes, chunk_size=16 * 1024 * 1024):
+    """Read n_bytes from filename starting at offset, using O_DIRECT to bypass the page cache.
+
+    O_DIRECT requires the file offset, the transfer size and the destination buffer all to be aligned,
+    so an aligned span covering the request is read into an anonymous (page-aligned) memory map and a
+    view of the requested bytes is returned. Returns None if the filesystem does not support O_DIRECT,
+    in which case the caller should fall back to an ordinary read."""
+    align = mmap.PAGESIZE
+    aligned_start = offset - offset % align
+    span = offset + n_bytes - aligned_start
+    span += -span % align
+    buf = mmap.mmap(-1, span)
+    view = memoryview(buf)
+    try:
+        fd = os.open(filename, os.O_RDONLY | os.O_DIRECT)
+    except OSError as error:
+        if error.errno == errno.EINVAL:
+            return None
+        raise
+    try:
+        pos = 0
+        while pos < span:
+            n_read = os.preadv(fd, [view[pos:pos + chunk_size]], aligned_start + pos)
+            if n_read == 0:
+                break
+            pos += n_read
+    except OSError as error:
+        if error.errno == errno.EINVAL:
+            return None
+        raise
+    finally:
+        os.close(fd)
+        view.release()
+
+    if pos < offset - aligned_start + n_bytes:
+        raise OSError("Could not read %d bytes at offset %d from %s" % (n_bytes, offset, filename))
+    return np.frombuffer(buf, dtype=np.uint8, count=n_bytes, offset=offset - aligned_start)
+
+
+def _write_buffers(fd, buffers, offset):
+    """Write a sequence of buffers contiguously to an open file, starting at offset.
+
+    Where available, this is a single os.pwritev call (repeated only if the kernel accepts a partial write), which
+    writes the record markers and payload of a block together and releases the GIL while it does so."""
+    if not hasattr(os, 'pwritev'):
+        fd.seek(offset)
+        for b in buffers:
+            fd.write(b)
+        return
+
+    fd.flush()
+    views = [memoryview(b).cast('B') for b in buffers]
+    while views:
+        n_written = os.pwritev(fd.fileno(), views, offset)
+        offset += n_written
+        while views and n_written >= len(views[0]):
+            n_written -= len(views[0])
+            views.pop(0)
+        if views:
+            views[0] = views[0][n_written:]
+
+
+def _map_over_files(function, per_file_args):
+    """Call function(*args) for each tuple in per_file_args, where each call touches a different sub-file,
+    and return the list of results in the same order.
+
+    Up to parallel-read (from the [gadget-io] config section) calls run at once, on a thread pool; the
+    copies between the files and memory release the GIL. Any exception is re-raised here."""
+    n_threads = min(_parallel_read, len(per_file_args))
+    if n_threads <= 1:
+        return [function(*args) for args in per_file_args]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+            return [future.result() for future in [executor.submit(function, *args) for args in per_file_args]]
+
+
 class _GadgetBlock:
 
     """Class to describe each block.
@@ -99,47 +231,26 @@ def _output_order_gadget(all_keys):
     return out + out_dregs
 
 
-def _construct_gadget_header(data, endian='='):
-    """Create a GadgetHeader from a byte range read from a file."""
-    npart = np.zeros(N_TYPE, dtype=np.uint32)
-    mass = np.zeros(N_TYPE)
-    time = 0.
-    redshift = 0.
-    npartTotal = np.zeros(N_TYPE, dtype=np.int32)
-    num_files = 0
-    BoxSize = 0.
-    Omega0 = 0.
-    OmegaLambda = 0.
-    HubbleParam = 0.
-    NallHW = np.zeros(N_TYPE, dtype=np.int32)
+def _construct_gadget_header(data, endian='=', offset=0):
+    """Create a GadgetHeader from a byte range read from a file, starting at the given offset."""
     if data == '':
         return
-    fmt = endian + "IIIIIIddddddddiiIIIIIIiiddddiiIIIIIIiiif48s"
-    if struct.calcsize(fmt) != 256:
-        raise Exception(
-            "There is a bug in gadget.py; the header format string is not 256 bytes")
-    (npart[0], npart[1], npart[2], npart[3], npart[4], npart[5],
-     mass[0], mass[1], mass[2], mass[3], mass[4], mass[5],
-     time, redshift,  flag_sfr, flag_feedback,
-     npartTotal[0], npartTotal[1], npartTotal[
-     2], npartTotal[3], npartTotal[4], npartTotal[5],
-     flag_cooling, num_files, BoxSize, Omega0, OmegaLambda, HubbleParam, flag_stellarage, flag_metals,
-     NallHW[0], NallHW[1], NallHW[2], NallHW[3], NallHW[4], NallHW[5],
-     flag_entropy_instead_u, flag_doubleprecision, flag_ic_info, lpt_scalingfactor, fill) = struct.unpack(fmt, data)
-
-    header = _GadgetHeader(npart, mass, time, redshift,
-                           BoxSize, Omega0, OmegaLambda, HubbleParam, num_files)
-    header.flag_sfr = flag_sfr
-    header.flag_feedback = flag_feedback
-    header.npartTotal = npartTotal
-    header.flag_cooling = flag_cooling
-    header.flag_stellarage = flag_stellarage
-    header.flag_metals = flag_metals
-    header.NallHW = NallHW
-    header.flag_entropy_instead_u = flag_entropy_instead_u
-    header.flag_doubleprecision = flag_doubleprecision
-    header.flag_ic_info = flag_ic_info
-    header.lpt_scalingfactor = lpt_scalingfactor
+    rec = np.frombuffer(data, dtype=_HEADER_DTYPE.newbyteorder(endian), count=1, offset=offset)[0]
+
+    header = _GadgetHeader(rec['npart'], rec['mass'].astype(np.float64), rec['time'].item(),
+                           rec['redshift'].item(), rec['BoxSize'].item(), rec['Omega0'].item(),
+                           rec['OmegaLambda'].item(), rec['HubbleParam'].item(), rec['num_files'].item())
+    header.flag_sfr = rec['flag_sfr'].item()
+    header.flag_feedback = rec['flag_feedback'].item()
+    header.npartTotal = rec['npartTotal'].astype(np.int32)
+    header.flag_cooling = rec['flag_cooling'].item()
+    header.flag_stellarage = rec['flag_stellarage'].item()
+    header.flag_metals = rec['flag_metals'].item()
+    header.NallHW = rec['NallHW'].astype(np.int32)
+    header.flag_entropy_instead_u = rec['flag_entropy_instead_u'].item()
+    header.flag_doubleprecision = rec['flag_doubleprecision'].item()
+    header.flag_ic_info = rec['flag_ic_info'].item()
+    header.lpt_scalingfactor = rec['lpt_scalingfactor'].item()
     header.endian = endian
 
     return header
@@ -211,22 +322,27 @@ class _GadgetHeader:
             self.header.npartTotal = np.array(
                 npart - 2 ** 32 * self.header.NallHW, dtype=np.int32)
 
+    def clone(self):
+        """Return an independent copy of this header. All attributes are immutable scalars or small
+        numpy arrays, so this is much cheaper than copy.deepcopy."""
+        header = copy.copy(self)
+        for k, v in self.__dict__.items():
+            if isinstance(v, np.ndarray):
+                setattr(header, k, v.copy())
+        return header
+
     def serialize(self):
         """This takes the header structure and returns it as a packed string"""
-        fmt = self.endian + "IIIIIIddddddddiiIIIIIIiiddddiiIIIIIIiiif"
         # Do not attempt to include padding in the serialised data; the most common use of serialise
         # is to write to a file and we don't want to overwrite extra data that
         # might be present
-        if struct.calcsize(fmt) != 256 - 48:
-            raise Exception(
-                "There is a bug in gadget.py; the header format string is not 256 bytes")
         # WARNING: On at least python 2.6.3 and numpy 1.3.0 on windows, castless code fails with:
         # SystemError: ..\Objects\longobject.c:336: bad argument to internal function
         # This is because self.npart, etc, has type np.uint32 and not int.
         # This is I think a problem with python/numpy, but cast things to ints
         # until I can determine how widespread it is.
-        data = struct.pack(
-            fmt, int(self.npart[0]), int(self.npart[1]), int(self.npart[
+        data = _HEADER_STRUCTS_NOPAD[self.endian].pack(
+            int(self.npart[0]), int(self.npart[1]), int(self.npart[
                                                              2]), int(
                                                                  self.npart[3]), int(
                                                                      self.npart[4]), int(
@@ -260,106 +376,87 @@ class _GadgetFile:
     def __init__(self, filename):
         self._filename = filename
         self.blocks = {}
+        self._part_counts = {}
         self.endian = ''
         self.format2 = True
-        t_part = 0
-        with open(filename, "rb") as fd:
-            self.check_format(fd)
+        self.extra = 0
+        # Cursor into block_names, for format-1 files
+        self._blk_idx = 0
+        # The block table is scanned from a read-only memory map, so that parsing each record
+        # header and footer does not require a separate read call
+        with open(filename, "rb") as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            self.check_format(buf)
+            offset = 0
             # If format 1, load the block definitions.
             if not self.format2:
-                self.block_names = config_parser.get(
-                    'gadget-1-blocks', "blocks").split(",")
-                self.block_names = [q.upper().ljust(4) for q in self.block_names]
-                if sys.version_info[0] > 2:
-                    self.block_names = [str.encode(x, 'utf-8') for x in self.block_names]
-                # This is a counter for the fallback
-                self.extra = 0
-            while True:
-                block = _GadgetBlock()
-                (name, block.length) = self.read_block_head(fd)
-                if block.length == 0:
-                    break
-                # Do special things for the HEAD block
-                if name[0:4] == b"HEAD":
-                    if block.length != 256:
-                        raise OSError("Mis-sized HEAD block in " + filename)
-                    self.header = fd.read(256)
-                    if len(self.header) != 256:
-                        raise OSError("Could not read HEAD block in " + filename)
-                    self.header = _construct_gadget_header(
-                        self.header, self.endian)
-                    record_size = self.read_block_foot(fd)
-                    if record_size != 256:
-                        raise OSError("Bad record size for HEAD in " + filename)
-                    t_part = self.header.npart.sum()
-                    if  ((not self.format2) and
-                        ((self.header.npart != 0) * (self.header.mass == 0)).sum()==0):
-                        # The "Spec" says that if all the existing particle masses
-                        # are in the header, we shouldn't have a MASS block
-                        self.block_names.remove(b"MASS")
-                    continue
-                # Set the partlen, using our amazing heuristics
-                success = False
-                if name[0:4] == b"POS " or name[0:4] == b"VEL ":
-                    if block.length == t_part * 24:
-                        block.partlen = 24
-                        block.data_type = np.float64
-                    else:
-                        block.partlen = 12
-                        block.data_type = np.float32
-                    block.p_types = self.header.npart != 0
-                    success = True
-                elif name[0:4] == b"ID  ":
-                    # Heuristic for long (64-bit) IDs
-                    if block.length == t_part * 4:
-                        block.partlen = 4
-                        block.data_type = np.int32
-                    else:
-                        block.partlen = 8
-                        block.data_type = np.int64
-                    block.p_types = self.header.npart != 0
-                    success = True
-
-                block.start = fd.tell()
-                # Check for the case where the record size overflows an int.
-                # If this is true, we can't get record size from the length and we just have to guess
-                # At least the record sizes at either end should be consistently wrong.
-                # Better hope this only happens for blocks where all particles are
-                # present.
-                extra_len = int(t_part) * block.partlen
-                if extra_len >= 2 ** 32:
-                    fd.seek(extra_len, 1)
-                else:
-                    fd.seek(block.length, 1)
-                record_size = self.read_block_foot(fd)
-                if record_size != block.length:
-                    raise OSError("Corrupt record in " +
-                                filename + " footer for block " + name + "dtype" + str(block.data_type))
-                if extra_len >= 2 ** 32:
-                    block.length = extra_len
-
-                if not success:
-                    # Figure out what particles are here and what types
-                    # they have. This also is a heuristic, which assumes
-                    # that blocks are either fully present or not for a
-                    # given particle. It also has to try all
-                    # possibilities of dimensions of array and data type.
-                    for dim, tp in (1, np.float32), (1, np.float64), (3, np.float32), (3, np.float64), (11, np.float32):
-                        try:
-                            block.data_type = tp
-                            block.partlen = np.dtype(tp).itemsize * dim
-                            block.p_types = self.get_block_types(
-                                block, self.header.npart)
-                            success = True
-                            break
-                        except ValueError:
-                            continue
-
-                if not success:
-                    warnings.warn("Encountered a gadget block %r which could not be interpreted - is it a strange length or data type (length=%d)?" %
-                                (name, block.length), RuntimeWarning)
-                else:
-                    self.blocks[name[0:4]] = block
+                # Normalise to the 4-character, space-padded, upper case form used in format-2 files
+                self.block_names = [q.strip().upper().ljust(4)[0:4].encode('utf-8') for q in
+                                    config_parser.get('gadget-1-blocks', "blocks").split(",")]
+            # The HEAD block always comes first
+            (name, length, offset) = self.read_block_head(buf, offset)
+            if name[0:4] != b"HEAD":
+                raise OSError("No HEAD block at start of " + filename)
+            if length != 256:
+                raise OSError("Mis-sized HEAD block in " + filename)
+            if offset + 256 > len(buf):
+                raise OSError("Could not read HEAD block in " + filename)
+            self.header = _construct_gadget_header(buf, self.endian, offset)
+            offset += 256
+            (record_size, offset) = self.read_block_foot(buf, offset)
+            if record_size != 256:
+                raise OSError("Bad record size for HEAD in " + filename)
+            t_part = self.header.npart.sum()
+            self._subset_table = _particle_subset_table(self.header.npart)
+            if  ((not self.format2) and
+                ((self.header.npart != 0) * (self.header.mass == 0)).sum()==0):
+                # The "Spec" says that if all the existing particle masses
+                # are in the header, we shouldn't have a MASS block
+                self.block_names.remove(b"MASS")
+
+            # Walk the remaining records in compiled code; this also sets the partlen of the POS,
+            # VEL and ID blocks, using our amazing heuristics
+            records, self.extra = _gadget_io.scan_blocks(buf, offset, self.format2, self.endian != '=',
+                                                         self.block_names if not self.format2 else [],
+                                                         self._blk_idx, int(t_part), str(filename))
+
+        if self.extra > 0:
+            warnings.warn(
+                "Run out of block names in the config file. Using fallbacks: UNK*", RuntimeWarning)
+
+        for (name, start, length, partlen) in records:
+            block = _GadgetBlock(start=start, length=length, partlen=partlen)
+            success = False
+            if name == b"POS " or name == b"VEL ":
+                block.data_type = np.float64 if partlen == 24 else np.float32
+                block.p_types = self.header.npart != 0
+                success = True
+            elif name == b"ID  ":
+                # Heuristic for long (64-bit) IDs
+                block.data_type = np.int32 if partlen == 4 else np.int64
+                block.p_types = self.header.npart != 0
+                success = True
+            else:
+                # Figure out what particles are here and what types
+                # they have. This also is a heuristic, which assumes
+                # that blocks are either fully present or not for a
+                # given particle. It also has to try all
+                # possibilities of dimensions of array and data type.
+                for dim, tp in (1, np.float32), (1, np.float64), (3, np.float32), (3, np.float64), (11, np.float32):
+                    try:
+                        block.data_type = tp
+                        block.partlen = np.dtype(tp).itemsize * dim
+                        block.p_types = self.get_block_types(
+                            block, self.header.npart)
+                        success = True
+                        break
+                    except ValueError:
+                        continue
+
+            if not success:
+                warnings.warn("Encountered a gadget block %r which could not be interpreted - is it a strange length or data type (length=%d)?" %
+                            (name, block.length), RuntimeWarning)
+            else:
+                self.blocks[name[0:4]] = block
 
         # Make a mass block if one isn't found.
         if b'MASS' not in self.blocks:
@@ -372,6 +469,9 @@ class _GadgetFile:
             block.partlen = np.dtype(block.data_type).itemsize
             self.blocks[b'MASS'] = block
 
+        # The last block in the file, after which add_file_block places new blocks
+        self._tail_block = max(self.blocks.values(), key=lambda val: val.start)
+
     def get_block_types(self, block, npart):
         """ Set up the particle types in the block, with a heuristic,
         which assumes that blocks are either fully present or not for a given particle type"""
@@ -380,24 +480,19 @@ class _GadgetFile:
         if block.length == totalnpart * block.partlen:
             p_types = np.ones(N_TYPE, bool)
             return p_types
-        p_types = np.zeros(N_TYPE, bool)
-        for blocknpart in [1, 2, 3, 4, 5]:
-            # iterate of differeent possible combinations of particles in the bloc
-            # we stop when we can we match the length of the block
-            for perm in itertools.permutations(list(range(0, N_TYPE)), blocknpart):
-                # the 64-bit calculation is important here
-                if block.length == (npart[list(perm)]).astype(np.int64).sum() * block.partlen:
-                    p_types[list(perm)] = True
-                    return p_types
+        # look up which combination of particle types matches the length of the block, using
+        # the table of subset totals built when the header was read
+        blocknpart, remainder = divmod(block.length, block.partlen)
+        if remainder == 0 and blocknpart in self._subset_table:
+            return self._subset_table[blocknpart].copy()
         raise ValueError("Could not determine particle types for block")
 
-    def check_format(self, fd):
-        """This function reads the first character of a file and, depending on its value, determines
+    def check_format(self, buf):
+        """This function reads the first integer of a file buffer and, depending on its value, determines
         whether we have a format 1 or 2 file, and whether the endianness is swapped. For the endianness,
         it then determines the correct byteorder string to pass to struct.unpack. There is not string
         for 'not native', so this is more complex than it needs to be"""
-        fd.seek(0, 0)
-        (r,) = struct.unpack('=I', fd.read(4))
+        (r,) = _U32_STRUCTS['='].unpack_from(buf, 0)
         if r == 8:
             self.endian = '='
             self.format2 = True
@@ -418,81 +513,136 @@ class _GadgetFile:
             self.format2 = False
         else:
             raise OSError("File corrupt. First integer is: " + str(r))
-        fd.seek(0, 0)
-        return
+        self._bind_structs()
+
+    def _bind_structs(self):
+        """Bind the precompiled record structs for the byte order of this file, once it is known"""
+        self._u32 = _U32_STRUCTS[self.endian]
+        self._block_head = _BLOCK_HEAD_STRUCTS[self.endian]
+        self._block_head_write = _BLOCK_HEAD_WRITE_STRUCTS[self.endian]
 
-    def read_block_foot(self, fd):
-        """Unpacks the block footer, into a single integer"""
-        record_size = fd.read(4)
-        if len(record_size) != 4:
+    def read_block_foot(self, buf, offset):
+        """Unpacks the block footer at the given offset into a buffer, returning a (record_size, new_offset) tuple"""
+        if offset + 4 > len(buf):
             raise OSError("Could not read block footer")
-        (record_size,) = struct.unpack(self.endian + 'I', record_size)
-        return record_size
+        (record_size,) = self._u32.unpack_from(buf, offset)
+        return (record_size, offset + 4)
 
-    def read_block_head(self, fd):
+    def read_block_head(self, buf, offset):
         """Read the Gadget 2 "block header" record, ie, 8 name, length, 8.
-           Takes an open file and returns a (name, length) tuple """
+           Takes a file buffer and offset and returns a (name, length, new_offset) tuple """
         if self.format2:
-            head = fd.read(5 * 4)
             # If we have run out of file, we don't want an exception,
             # we just want a zero length empty block
-            if len(head) != 5 * 4:
-                return ("    ", 0)
-            head = struct.unpack(self.endian + 'I4sIII', head)
+            if offset + 5 * 4 > len(buf):
+                return ("    ", 0, offset)
+            head = self._block_head.unpack_from(buf, offset)
             if head[0] != 8 or head[3] != 8 or head[4] != head[2] - 8:
                 raise OSError(
                     "Corrupt header record. Possibly incorrect file format")
             # Don't include the two "record_size" indicators in the total
             # length count
-            return (head[1], head[2] - 8)
+            return (head[1], head[2] - 8, offset + 5 * 4)
         else:
-            record_size = fd.read(4)
-            if len(record_size) != 4:
-                return ("    ", 0)
-            (record_size,) = struct.unpack(self.endian + 'I', record_size)
+            if offset + 4 > len(buf):
+                return ("    ", 0, offset)
+            (record_size,) = self._u32.unpack_from(buf, offset)
             try:
-                name = self.block_names[0]
-                self.block_names = self.block_names[1:]
+                name = self.block_names[self._blk_idx]
+                self._blk_idx += 1
             except IndexError:
                 if self.extra == 0:
                     warnings.warn(
                         "Run out of block names in the config file. Using fallbacks: UNK*", RuntimeWarning)
                 name = _to_raw("UNK" + str(self.extra))
                 self.extra += 1
-            return (name, record_size)
+            return (name, record_size, offset + 4)
 
     def get_block(self, name, p_type, p_toread):
         """Get a particle range from this file, starting at p_start,
         and reading a maximum of p_toread particles"""
         name = _to_raw(name)
+        cur_block = self.blocks[name]
+        (p_toread, data) = self._get_block_bytes(name, p_type, p_toread)
+        # An owned, native-endian copy, so that nothing refers to the file's memory map once we return
+        data = data.view(np.dtype(cur_block.data_type).newbyteorder(self.endian)).astype(cur_block.data_type)
+        return (p_toread, data)
 
-        p_read = 0
+    def get_block_into(self, name, p_type, out):
+        """Read all particles of the given type from a block into the flat array out, which must be of the right
+        length. Byte-swapping and any conversion to the type of out is done during the copy. Returns the number of
+        particles read."""
+        name = _to_raw(name)
+        cur_block = self.blocks[name]
+        (p_toread, data) = self._get_block_bytes(name, p_type, self.get_block_parts(name, p_type))
+        out[...] = data.view(np.dtype(cur_block.data_type).newbyteorder(self.endian))
+        return p_toread
+
+    def prefetch_block(self, name, p_type):
+        """Ask the operating system to start reading all particles of the given type from a block into the page
+        cache, without waiting for it to do so. Does nothing on platforms without posix_fadvise."""
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        name = _to_raw(name)
+        cur_block = self.blocks[name]
+        offset = cur_block.start + int(cur_block.partlen * self.get_start_part(name, p_type))
+        n_bytes = int(self.get_block_parts(name, p_type) * cur_block.partlen)
+        fd = os.open(self._filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, offset, n_bytes, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    def _get_block_bytes(self, name, p_type, p_toread):
+        """Get the raw bytes for a particle range from this file, as for get_block"""
         cur_block = self.blocks[name]
         parts = self.get_block_parts(name, p_type)
         p_start = self.get_start_part(name, p_type)
         if p_toread > parts:
             p_toread = parts
-        with open(self._filename, 'rb') as fd:
-            fd.seek(cur_block.start + int(cur_block.partlen * p_start), 0)
-            # This is just so that we can get a size for the type
-            dt = np.dtype(cur_block.data_type)
-            n_type = p_toread * cur_block.partlen // dt.itemsize
-            data = np.fromfile(
-                fd, dtype=cur_block.data_type, count=n_type, sep='')
-
-        if self.endian != '=':
-            data = data.byteswap(True)
+        offset = cur_block.start + int(cur_block.partlen * p_start)
+        n_bytes = int(p_toread * cur_block.partlen)
+        data = None
+        if _direct_io and n_bytes >= _direct_io_min_bytes:
+            data = _read_direct(self._filename, offset, n_bytes)
+        if data is None:
+            data = self._map_file()[offset:offset + n_bytes]
         return (p_toread, data)
 
+    def map_block(self, name, p_start, p_count):
+        """Return a writable, copy-on-write memory map of p_count particles of a block, starting from particle
+        p_start, as a flat array of the block's type. The file must have native byte order.
+
+        Unlike ordinary reads, the map lives as long as the returned array (and anything viewing it), so the
+        file must not be truncated or replaced on disk in the meantime."""
+        name = _to_raw(name)
+        cur_block = self.blocks[name]
+        with open(self._filename, 'rb') as fd:
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_COPY)
+        dt = np.dtype(cur_block.data_type)
+        return np.frombuffer(mm, dtype=dt, count=int(p_count * cur_block.partlen) // dt.itemsize,
+                             offset=int(cur_block.start + cur_block.partlen * p_start))
+
+    def _map_file(self):
+        """Return a read-only memory map of the whole file, as a flat uint8 array.
+
+        A new map is made on every call and is not kept by this object: it is unmapped as soon as the
+        returned array and any views of it are released, which for reads is when the data has been copied
+        out. The file is therefore never held open (or mapped) between reads, and each read sees the file's
+        current size."""
+        # A plain ndarray over the map, rather than np.memmap, so that slicing it is as cheap as possible
+        with open(self._filename, 'rb') as fd:
+            return np.frombuffer(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ), dtype=np.uint8)
+
     def get_block_parts(self, name, p_type):
         """Get the number of particles present in a block in this file"""
-        if name not in self.blocks:
+        cur_block = self.blocks.get(name)
+        if cur_block is None:
             return 0
-        cur_block = self.blocks[name]
         if p_type == -1:
             return cur_block.length // cur_block.partlen
         else:
-            return self.header.npart[p_type] * cur_block.p_types[p_type]
+            return self._get_part_counts(name)[0][p_type]
 
     def get_start_part(self, name, p_type):
         """Find particle to skip to before starting, if reading particular type"""
@@ -501,14 +651,23 @@ class _GadgetFile:
         else:
             if name not in self.blocks:
                 return 0
-            cur_block = self.blocks[name]
-            return (cur_block.p_types * self.header.npart)[0:p_type].sum().astype(int)
+            return self._get_part_counts(name)[1][p_type]
+
+    def _get_part_counts(self, name):
+        """Get the number of particles of each type present in a block, and the offset (in particles) of each type
+        within the block. These are computed once per block and then cached."""
+        part_counts = self._part_counts.get(name)
+        if part_counts is None:
+            parts = self.blocks[name].p_types * self.header.npart
+            part_counts = (parts, np.concatenate(([0], np.cumsum(parts, dtype=np.int64))))
+            self._part_counts[name] = part_counts
+        return part_counts
 
     def get_block_dims(self, name):
         """Get the dimensionality of the block, eg, 3 for POS, 1 for most other things"""
-        if name not in self.blocks:
+        cur_block = self.blocks.get(name)
+        if cur_block is None:
             return 0
-        cur_block = self.blocks[name]
         dt = np.dtype(cur_block.data_type)
         return cur_block.partlen // dt.itemsize
 
@@ -541,28 +700,23 @@ class _GadgetFile:
         # Open the file
         fn = self._filename if filename is None else filename
 
-        with open(fn, 'r+b') as fd:
-            # Seek to the start of the block
-            fd.seek(cur_block.start + cur_block.partlen * p_start, 0)
-            # Add the block header if we are at the start of a block
-            if p_type == MinType or p_type < 0:
-                data = self.write_block_header(name, cur_block.length)
-                # Better seek back a bit first.
-                fd.seek(-len(data), 1)
-                fd.write(data)
-
-            if self.endian != '=':
-                big_data = big_data.byteswap(False)
-
-            # Actually write the data
-            # Make sure to ravel it, otherwise the wrong amount will be written,
-            # because it will also write nulls every time the first array dimension
-            # changes.
-            d = np.ravel(big_data.astype(dt)).tobytes()
-            fd.write(d)
-            if p_type == MaxType or p_type < 0:
-                data = self.write_block_footer(name, cur_block.length)
-                fd.write(data)
+        offset = int(cur_block.start + cur_block.partlen * p_start)
+        buffers = []
+        # Add the block header if we are at the start of a block
+        if p_type == MinType or p_type < 0:
+            data = self.write_block_header(name, cur_block.length)
+            offset -= len(data)
+            buffers.append(data)
+
+        # Actually write the data. The conversion to the on-disk type and byte order
+        # is done in a single pass, and makes a C-contiguous copy only if needed, so
+        # that the right amount (and order) of data is written.
+        buffers.append(np.ascontiguousarray(big_data, dtype=dt.newbyteorder(self.endian)))
+        if p_type == MaxType or p_type < 0:
+            buffers.append(self.write_block_footer(name, cur_block.length))
+
+        with self._open_for_writing(fn) as fd:
+            _write_buffers(fd, buffers, offset)
 
     def add_file_block(self, name, blocksize, partlen=4, dtype=np.float32, p_types=None):
         """Add a block to the block table at the end of the file. Do not actually write anything"""
@@ -573,7 +727,7 @@ class _GadgetFile:
                 "Block " + name + " already present in file. Not adding")
 
         # Get last block
-        lb = max(list(self.blocks.values()), key=lambda val: val.start)
+        lb = self._tail_block
 
         if np.issubdtype(dtype, np.floating):
             dtype = np.float32  # coerce to single precision
@@ -587,6 +741,8 @@ class _GadgetFile:
         else:
             block.p_types = p_types
         self.blocks[name] = block
+        self._part_counts.pop(name, None)
+        self._tail_block = block
 
     def write_block_header(self, name, blocksize):
         """Create a string for a Gadget-style block header, but do not actually write it, for atomicity."""
@@ -598,52 +754,87 @@ class _GadgetFile:
             nextblock = blocksize + 2 * 4
             # Relative location of next block; the extra 2 uints are for storing the headers.
             # Write format 2 header header
-            head = struct.pack(
-                self.endian + 'I4sII', blkheadsize, name, nextblock, blkheadsize)
+            head = self._block_head_write.pack(blkheadsize, name, nextblock, blkheadsize)
         # Also write the record size, which we want for all files*/
         head += self.write_block_footer(name, blocksize)
         return head
 
     def write_block_footer(self, name, blocksize):
         """(Re) write a Gadget-style block footer."""
-        return struct.pack(self.endian + 'I', blocksize)
+        return self._u32.pack(blocksize)
 
     def write_header(self, head_in, filename=None):
         """Write a file header. Overwrites npart in the argument with the npart of the file, so a consistent file is always written."""
         # Construct new header with the passed header and overwrite npart with the file header.
         # This has ref. semantics so use copy
-        head = copy.deepcopy(head_in)
+        head = head_in.clone()
         head.npart = np.array(self.header.npart)
         data = self.write_block_header(b"HEAD", 256)
         data += head.serialize()
         if filename is None:
             filename = self._filename
 
+        with self._open_for_writing(filename, create=True) as fd:
+            fd.seek(0)  # Header always at start of file
+            # Write header
+            fd.write(data)
+            # Seek 48 bytes forward, to skip the padding (which may contain extra
+            # data)
+            fd.seek(48, 1)
+            data = self.write_block_footer(b"HEAD", 256)
+            fd.write(data)
+
+    @contextlib.contextmanager
+    def batch_writes(self):
+        """Within this context, write_block and write_header keep a single handle open for each file they write to,
+        rather than reopening the file on every call."""
+        self._write_handles = {}
+        try:
+            yield
+        finally:
+            handles, self._write_handles = self._write_handles, None
+            for fd in handles.values():
+                fd.close()
+
+    def _open_for_writing(self, filename, create=False):
+        """Return a context manager yielding a file handle for writing to filename, reusing any handle kept open by
+        batch_writes. If create is True, the file is created if it does not exist."""
+        handles = getattr(self, '_write_handles', None)
+        if handles is not None and filename in handles:
+            return _FlushingHandle(handles[filename], close=False)
         try:
             fd = open(filename, "r+b")
         except OSError as error:
             # If we couldn't open it because it doesn't exist open it for
             # writing.
             (err, strerror) = error.args
-            # If we couldn't open it because it doesn't exist open it for
-            # writing.
-            if err == errno.ENOENT:
+            if create and err == errno.ENOENT:
                 fd = open(filename, "w+b")
             # If we couldn't open it for any other reason, reraise exception
             else:
                 raise OSError(err, strerror)
+        if handles is not None:
+            handles[filename] = fd
+            return _FlushingHandle(fd, close=False)
+        return _FlushingHandle(fd, close=True)
 
-        try:
-            fd.seek(0)  # Header always at start of file
-            # Write header
-            fd.write(data)
-            # Seek 48 bytes forward, to skip the padding (which may contain extra
-            # data)
-            fd.seek(48, 1)
-            data = self.write_block_footer(b"HEAD", 256)
-            fd.write(data)
-        finally:
-            fd.close()
+
+class _FlushingHandle:
+    """Context manager for a file handle that is flushed on exit, so that the data is visible through any memory map
+    of the file, and optionally closed"""
+
+    def __init__(self, fd, close):
+        self._fd = fd
+        self._close = close
+
+    def __enter__(self):
+        return self._fd
+
+    def __exit__(self, *exc_info):
+        if self._close:
+            self._fd.close()
+        else:
+            self._fd.flush()
 
 
 class _GadgetWriteFile(_GadgetFile):
@@ -656,7 +847,9 @@ class _GadgetWriteFile(_GadgetFile):
         self._filename = filename
         self.endian = '='  # write with default endian of this system
         self.format2 = format2
+        self._bind_structs()
         self.blocks = {}
+        self._part_counts = {}
         self.header.npart = np.array(npart)
         # Set up the positions
         header_size = 4
@@ -675,6 +868,8 @@ class _GadgetWriteFile(_GadgetFile):
                 cur_pos += b.length + header_size + footer_size
                 self.blocks[_to_raw(block.name)] = b
 
+        self._tail_block = max(self.blocks.values(), key=lambda val: val.start, default=None)
+
 
 class _WriteBlock:
 
@@ -721,7 +916,6 @@ class GadgetSnap(SimSnap):
         first_file = _GadgetFile(filename)
         self._files.append(first_file)
         files_expected = self._files[0].header.num_files
-        npart = np.array(self._files[0].header.npart,dtype=np.uint64) # 64-bit necessary in numpy 2.0 because of changes to data type promotion rules in the 2 * 32 calc below
 
         if files is None:
             # we want to load all files
@@ -729,21 +923,25 @@ class GadgetSnap(SimSnap):
             files = [base_filename + "." + str(i)
                      for i in range(files_expected)]
 
-        for filename in files[1:]:
-            tmp_file = _GadgetFile(filename)
+        # The remaining files are independent of one another, so their block tables can be scanned concurrently
+        other_files = _map_over_files(_GadgetFile, [(f,) for f in files[1:]])
+
+        for filename, tmp_file in zip(files[1:], other_files):
             if not self.check_headers(tmp_file.header, self._files[0].header):
-                warnings.warn("file " + str(
-                    i) + " is not part of this snapshot set!", RuntimeWarning)
+                warnings.warn("file " + filename + " is not part of this snapshot set!", RuntimeWarning)
                 continue
             self._files.append(tmp_file)
-            npart = npart + tmp_file.header.npart
+
+        # 64-bit necessary in numpy 2.0 because of changes to data type promotion rules in the 2 * 32 calc below
+        npart = np.stack([f.header.npart for f in self._files]).astype(np.uint64).sum(axis=0)
         # Set up things from the parent class
         self._num_particles = npart.sum()
         # Set up global header
-        self.header = copy.deepcopy(self._files[0].header)
+        self.header = self._files[0].header.clone()
         self.header.npart = npart
         # Check and fix npartTotal and NallHW if they are wrong.
-        if npart is not self.header.npartTotal.astype(np.uint64) + 2 ** 32 * self.header.NallHW.astype(np.uint64):
+        if not np.array_equal(npart, self.header.npartTotal.astype(np.int64) +
+                              (1 << 32) * self.header.NallHW.astype(np.int64)):
             self.header.NallHW = npart // 2 ** 32
             self.header.npartTotal = npart - 2 ** 32 * self.header.NallHW
             for f in self._files:
@@ -751,6 +949,8 @@ class GadgetSnap(SimSnap):
                 f.header.NallHW = self.header.NallHW
 
         self._family_slice = {}
+        # Cache for get_block_parts, which must be cleared if blocks are added to the files
+        self._block_parts = {}
 
         self._loadable_keys = set()
         self._family_keys = set()
@@ -761,28 +961,26 @@ class GadgetSnap(SimSnap):
         # Set up _family_slice
         current = 0
         for fam in _type_map:
-            g_types = _type_map[fam]
-            length = 0
-            for f in self._files:
-                length += sum(f.header.npart[x] for x in g_types)
+            length = int(npart[_type_map[fam]].sum())
             self._family_slice[fam] = slice(current, current + length)
             current += length
 
         # Set up _loadable_keys
-        for f in self._files:
-            self._loadable_keys = self._loadable_keys.union(
-                set(f.blocks.keys()))
+        self._loadable_keys = self._loadable_keys.union(*[f.blocks.keys() for f in self._files])
 
         # Add default mapping to unpadded lower case if not in config file.
+        name_maps_changed = False
         for nn in self._loadable_keys:
-            if sys.version_info[0] == 2:
-                mm = nn.lower().strip()
-            else:
-                mm = nn.lower().strip().decode('utf-8')
+            mm = nn.lower().strip().decode('utf-8')
             if nn not in _rev_name_map:
                 _rev_name_map[nn] = mm
+                name_maps_changed = True
             if mm not in _name_map:
                 _name_map[mm] = nn
+                name_maps_changed = True
+
+        if name_maps_changed:
+            _translate_array_name.cache_clear()
 
         # Use translated keys only
         self._loadable_keys = [_translate_array_name(
@@ -828,19 +1026,31 @@ class GadgetSnap(SimSnap):
         # Special case mass. Note b_list has reference semantics.
         if b"MASS" in b_list:
             b_list[b"MASS"] += np.array(self.header.mass, dtype=bool)
-        # Translate this array into families and external names
+        # Translate this array into families and external names. A block belongs to a family if it is
+        # present for all of the family's gadget types that actually have particles in the snap; the
+        # relevant types for each family are tabulated once, so each block is then one array operation.
+        families = self.families()
+        family_types = np.zeros((len(families), N_TYPE), dtype=bool)
+        for i, f in enumerate(families):
+            family_types[i, gadget_type(f)] = True
+        family_types &= self.header.npart != 0
+        families = np.array(families, dtype=object)
+
         out_list = {}
         for k, b in b_list.items():
             b_name = _translate_array_name(k, reverse=True)
-            # Make this be only if there are actually particles of that type in
-            # the snap
-            b_types = [f for f in self.families() if b[np.intersect1d(
-                gadget_type(f), np.ravel(np.where(self.header.npart != 0)))].all()]
-            out_list[b_name] = b_types
+            out_list[b_name] = list(families[~(family_types & ~b).any(axis=1)])
         return out_list
 
     def get_block_parts(self, name, family):
         """Get the number of particles present in a block, of a given type"""
+        key = (name, tuple(family) if isinstance(family, list) else family)
+        if key not in self._block_parts:
+            self._block_parts[key] = self._count_block_parts(name, family)
+        return self._block_parts[key]
+
+    def _count_block_parts(self, name, family):
+        """Work out the number of particles present in a block, of a given type, for get_block_parts"""
         total = 0
         for f in self._files:
             total += sum(f.get_block_parts(
@@ -851,22 +1061,18 @@ class GadgetSnap(SimSnap):
                          p], dtype=bool) for p in gadget_type(family))
         return total
 
+    # Scalar header fields which must agree between all files in a snapshot set
+    _consistent_header_fields = operator.attrgetter('time', 'redshift', 'flag_sfr', 'flag_feedback', 'num_files',
+                                                    'BoxSize', 'Omega0', 'OmegaLambda', 'HubbleParam',
+                                                    'flag_stellarage', 'flag_metals')
+
     def check_headers(self, head1, head2):
         """Check two headers for consistency"""
-        if (head1.time != head2.time or head1.redshift != head2.redshift or
-                head1.flag_sfr != head2.flag_sfr or
-                head1.flag_feedback != head2.flag_feedback or
-                head1.num_files != head2.num_files or
-                head1.BoxSize != head2.BoxSize or
-                head1.Omega0 != head2.Omega0 or
-                head1.OmegaLambda != head2.OmegaLambda or
-                head1.HubbleParam != head2.HubbleParam or
-                head1.flag_stellarage != head2.flag_stellarage or
-                head1.flag_metals != head2.flag_metals):
+        if self._consistent_header_fields(head1) != self._consistent_header_fields(head2):
             return False
         # Check array quantities
         if (((head1.mass - head2.mass) > 1e-5 * head1.mass).any() or
-                (head1.npartTotal != head2.npartTotal).any()):
+                not np.array_equal(head1.npartTotal, head2.npartTotal)):
             return False
         #  At least one version of N-GenICs writes a header file which
         #  ignores everything past flag_metals (!), leaving it uninitialised.
@@ -912,64 +1118,131 @@ class GadgetSnap(SimSnap):
         else:
             p_types = gadget_type(self.families())
 
-        # Get the data. Get one type at a time and then concatenate.
-        # A possible optimisation is to special-case loading all particles.
-        data = np.array([], dtype=self._get_array_type(name))
-        for p in p_types:
+        if _mmap_arrays:
+            data = self.__map_array(g_name, p_types, dims)
+            if data is not None:
+                if fam is None:
+                    self._create_array(name, ndim, dtype=data.dtype, source_array=data)
+                    self[name].set_default_units(quiet=True)
+                else:
+                    self._create_family_array(name, fam, ndim, dtype=data.dtype, source_array=data)
+                    self[fam][name].set_default_units(quiet=True)
+                return
+
+        # Get the data. Each type is read, one file at a time, straight into its slice of the
+        # output array.
+        g_ndim = self._get_array_dims(g_name)
+        lengths = [int(self.header.npart[p]) if (g_name == b"MASS" and self.header.mass[p] != 0.)
+                   else int(g_ndim * self.header.npart[p]) for p in p_types]
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        if offsets[-1] != np.prod(dims):
+            raise ValueError("Inconsistent number of particles on disk for " + name)
+        # Allocated as a SimArray of the final shape from the outset (SimArray's constructor would copy),
+        # and filled through a flat view, which is always possible since the array is C-contiguous. Every
+        # element is written below, so there is no need to zero it first.
+        data = np.empty(dims, dtype=self._get_array_type(name)).view(array.SimArray)
+        data_flat = data.reshape(-1)
+        for p, start, end in zip(p_types, offsets[:-1], offsets[1:]):
             # Special-case mass
             if g_name == b"MASS" and self.header.mass[p] != 0.:
-                mass_as_correct_type = self.header.mass[p].astype(self._get_array_type(name))
-                data = np.append(data, np.repeat(mass_as_correct_type, self.header.npart[p]))
+                data_flat[start:end] = self.header.mass[p]
             else:
-                data = np.append(data, self.__load_array(g_name, p))
+                self.__load_array_into(g_name, p, data_flat[start:end])
 
         if fam is None:
-            self[name] = data.reshape(dims, order='C').view(array.SimArray)
+            self[name] = data
             self[name].set_default_units(quiet=True)
         else:
-            self[fam][name] = data.reshape(
-                dims, order='C').view(array.SimArray)
+            self[fam][name] = data
             self[fam][name].set_default_units(quiet=True)
 
-    def __load_array(self, g_name, p_type):
+    def __map_array(self, g_name, p_types, dims):
+       """Internal helper function for _load_array which returns the requested particles as a SimArray memory
+       mapped from the file, if they are stored contiguously in a single native-endian file, or None otherwise."""
+       if len(self._files) != 1:
+           return None
+       f = self._files[0]
+       if f.endian != '=' or g_name not in f.blocks:
+           return None
+       spans = []
+       for p in p_types:
+           if self.header.npart[p] == 0:
+               continue
+           if g_name == b"MASS" and self.header.mass[p] != 0.:
+               return None
+           spans.append((f.get_start_part(g_name, p), f.get_block_parts(g_name, p)))
+       if len(spans) == 0 or any(start + count != next_start for (start, count), (next_start, _)
+                                 in zip(spans[:-1], spans[1:])):
+           return None
+       p_count = sum(count for _, count in spans)
+       data = f.map_block(g_name, spans[0][0], p_count)
+       if data.size != np.prod(dims):
+           return None
+       return data.reshape(dims).view(array.SimArray)
+
+    def __load_array_into(self, g_name, p_type, out):
        """Internal helper function for _load_array that takes a g_name and a gadget type,
-       gets the data from each file and returns it as one long array."""
-       # int cast necessary because numpy makes int * uint64 a float!
-       data = np.zeros(int(self._get_array_dims(g_name) * self.header.npart[p_type]), dtype=self._get_array_type_g(g_name))
-       # Get a type from each file
+       and reads the data from each file into consecutive sections of out."""
+       reads = []
        ipos = 0
        for f in self._files:
            f_parts = f.get_block_parts(g_name, p_type)
            if f_parts == 0:
                continue
-           (f_read, f_data) = f.get_block(g_name, p_type, f_parts)
+           # int cast necessary because numpy makes int * uint64 a float!
+           iread = int(self._get_array_dims(g_name) * f.header.npart[p_type])
+           reads.append((f, f_parts, out[ipos:ipos + iread]))
+           ipos += iread
+
+       # Queue up the reads for all files at once, so that the disk can work on them together
+       if len(reads) > 1:
+           for f, _, _ in reads:
+               f.prefetch_block(g_name, p_type)
+
+       def read_one(f, f_parts, f_out):
+           f_read = f.get_block_into(g_name, p_type, f_out)
            if f_read != f_parts:
                raise OSError("Read of " + f._filename + " asked for " + str(
                    f_parts) + " particles but got " + str(f_read))
-           iread = self._get_array_dims(g_name)*f.header.npart[p_type]
-           data[ipos:ipos + iread] = f_data
-           ipos += iread
-       return data
+
+       _map_over_files(read_one, reads)
 
     @classmethod
     def _can_load(cls, f: pathlib.Path):
         """Check whether we can load the file as Gadget format by reading
         the first 4 bytes"""
         fname = f
-        if not f.exists():
+        try:
+            st = os.stat(fname)
+        except OSError:
             fname = f.parent / (f.name + ".0")
-            if not fname.exists():
+            try:
+                st = os.stat(fname)
+            except OSError:
                 return False
 
-        with open(fname, "br") as fd:
-            r, = struct.unpack('=I', fd.read(4))
+        # Anything smaller than a header can't be a gadget file, and needn't be opened
+        if st.st_size < 256:
+            return False
+
+        # A bare descriptor avoids setting up a buffered file object just to read 4 bytes
+        try:
+            fd = os.open(fname, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        except OSError:
+            return False
+        try:
+            buf = os.read(fd, 4)
+        except OSError:
+            return False
+        finally:
+            os.close(fd)
+        if len(buf) < 4:
+            return False
+        r, = _U32_STRUCTS['='].unpack_from(buf, 0)
 
         # First int32 is 8 for a Gadget 2 file, or 256 for Gadget 1, or the
         # byte swapped equivalent.
-        if r in (8, 134217728, 65536, 256):
-            return True
-        else:
-            return False
+        return r in _MAGIC_NUMBERS
 
     @staticmethod
     def _write(self, filename=None):
@@ -1005,7 +1278,7 @@ class GadgetSnap(SimSnap):
                     # Note that if we have more than one type per family, we cannot
                     # determine which type each individual particle is, so
                     # assume they are all the first.
-                    npart[np.min(gadget_type(f))] = len(self[f][arr_name])
+                    npart[_first_type_map[f]] = len(self[f][arr_name])
                 # Construct a header
                 # npart, mass, time, redshift, BoxSize,Omega0, OmegaLambda,
                 # HubbleParam, num_files=1
@@ -1032,7 +1305,7 @@ class GadgetSnap(SimSnap):
                     for f in self.families():
                         try:
                             dtype = self[f][k].dtype
-                            types[np.min(gadget_type(f))] += True
+                            types[_first_type_map[f]] += True
                             try:
                                 partlen = np.shape(self[
                                                    f][k])[1]  # *dtype.itemsize
@@ -1046,37 +1319,51 @@ class GadgetSnap(SimSnap):
                 # Create an output file
                 out_file = _GadgetWriteFile(
                     filename, npart, block_names, gheader)
-                # Write the header
-                out_file.write_header(gheader, filename)
-                # Write all the arrays
-                for x in all_keys:
-                    g_name = _to_raw(
-                        _translate_array_name(x).upper().ljust(4)[0:4])
-
-                    for fam in self.families():
-                        try:
-                            data = self[fam][x]
-                            gfam = np.min(gadget_type(fam))
-                            out_file.write_block(
-                                g_name, gfam, data, filename=filename)
-                        except KeyError:
-                            pass
+                with out_file.batch_writes():
+                    GadgetSnap._write_new_file(self, out_file, gheader, all_keys, filename)
                 return
 
-            # Write headers
-            if filename is not None:
-                if np.size(self._files) > 1:
-                    for i in np.arange(0, np.size(self._files)):
-                        ffile = filename + "." + str(i)
-                        self._files[i].write_header(self.header, ffile)
-                else:
-                    self._files[0].write_header(self.header, filename)
+            with contextlib.ExitStack() as stack:
+                for f in self._files:
+                    stack.enter_context(f.batch_writes())
+                GadgetSnap._write_existing_files(self, all_keys, filename)
+
+    @staticmethod
+    def _write_new_file(self, out_file, gheader, all_keys, filename):
+        """Write the header and all arrays of a snapshot of another type to a newly constructed gadget file"""
+        # Write the header
+        out_file.write_header(gheader, filename)
+        # Write all the arrays
+        for x in all_keys:
+            g_name = _to_raw(
+                _translate_array_name(x).upper().ljust(4)[0:4])
+
+            for fam in self.families():
+                try:
+                    data = self[fam][x]
+                    gfam = _first_type_map[fam]
+                    out_file.write_block(
+                        g_name, gfam, data, filename=filename)
+                except KeyError:
+                    pass
+
+    @staticmethod
+    def _write_existing_files(self, all_keys, filename):
+        """Write the headers and all arrays of a gadget snapshot back to its files, or to a new set of files"""
+        # Write headers
+        if filename is not None:
+            if np.size(self._files) > 1:
+                for i in np.arange(0, np.size(self._files)):
+                    ffile = filename + "." + str(i)
+                    self._files[i].write_header(self.header, ffile)
             else:
-                # Call write_header for every file.
-                [f.write_header(self.header) for f in self._files]
-            # Call _write_array for every array.
-            for x in all_keys:
-                GadgetSnap._write_array(self, x, filename=filename)
+                self._files[0].write_header(self.header, filename)
+        else:
+            # Call write_header for every file.
+            [f.write_header(self.header) for f in self._files]
+        # Call _write_array for every array.
+        for x in all_keys:
+            GadgetSnap._write_array(self, x, filename=filename)
 
     @staticmethod
     def _write_array(self, array_name, fam=None, filename=None):
@@ -1087,76 +1374,81 @@ class GadgetSnap(SimSnap):
         # trailing spaces
         g_name = _to_raw(
             _translate_array_name(array_name).upper().ljust(4)[0:4])
-        nfiles = np.size(self._files)
+        nfiles = len(self._files)
         # Find where each particle goes
-        f_parts = [f.get_block_parts(g_name, -1) for f in self._files]
+        f_parts = np.fromiter((f.get_block_parts(g_name, -1) for f in self._files), dtype=np.int64, count=nfiles)
         # If there is no block corresponding to this name in the file,
         # add it (so we can write derived arrays).
-        if np.sum(f_parts) == 0:
-            # Get p_type
-            p_types = np.zeros(N_TYPE, bool)
+        if f_parts.sum() == 0:
+            # Get p_type. We get the particle types we want by seeing which
+            # families have the array (in memory)
+            fam_arrays = [(fam, self[fam][array_name]) for fam in self.families() if array_name in self[fam]]
+            p_types = np.zeros(N_TYPE, dtype=bool)
+            p_types[[_first_type_map[fam] for fam, _ in fam_arrays]] = True
             npart = 0
-            for fam in self.families():
-                gfam = np.min(gadget_type(fam))
-                # We get the particle types we want by trying to load all
-                # particle types (from memory) and seeing which ones work
-                p_types[gfam] = array_name in self[fam]
-                if p_types[gfam]:
-                    ashape = np.shape(self[fam][array_name])
-                    # If the partlen is 1, append so the shape array has the
-                    # right shape.
-                    if np.size(ashape) < 2:
-                        ashape = (ashape[0], 1)
-                    npart += ashape[0]
+            for _, a in fam_arrays:
+                ashape = np.shape(a)
+                adtype = a.dtype
+                # If the partlen is 1, append so the shape array has the
+                # right shape.
+                if np.size(ashape) < 2:
+                    ashape = (ashape[0], 1)
+                npart += ashape[0]
             if p_types.sum():
                 per_file = npart // nfiles
-                for f in self._files[:-2]:
+                for f in self._files[:-1]:
                     f.add_file_block(array_name, per_file, ashape[
-                                     1], dtype=self[array_name].dtype, p_types=p_types)
+                                     1], dtype=adtype, p_types=p_types)
                 self._files[-1].add_file_block(
-                    array_name, npart - (nfiles - 1) * per_file, ashape[1])
+                    array_name, npart - (nfiles - 1) * per_file, ashape[1], dtype=adtype, p_types=p_types)
+                self._block_parts.clear()
+
+        # Output filenames for each file, if writing somewhere new
+        if filename is None:
+            ffiles = [None] * nfiles
+        elif nfiles == 1:
+            ffiles = [filename]
+        else:
+            ffiles = [filename + "." + str(i) for i in range(nfiles)]
 
         # Write blocks on a family level, so that we don't have to worry about
         # the file-level re-ordering.
-        for fam in write_fam:
-            if self._family_has_loadable_array(fam, array_name):
-                data = self[fam][array_name]
-                s = 0
-                for gfam in gadget_type(fam):
-                    # Find where each particle goes
-                    f_parts = [f.get_block_parts(
-                        g_name, gfam) for f in self._files]
-                    for i in np.arange(0, nfiles):
-                        if f_parts[i]==0:
-                            continue
-                        # Set up filename
-                        if filename is not None:
-                            ffile = filename + "." + str(i)
-                            if nfiles == 1:
-                                ffile = filename
-                        else:
-                            ffile = None
-                        # Special-case MASS.
-                        if g_name == b"MASS" and self.header.mass[gfam] != 0.:
-                            nmass = np.min(
-                                data[s:(s + self.header.npart[gfam])])
-                            # Warn if there are now different masses for this particle type,
-                            # as this information cannot be represented in this
-                            # snapshot.
-                            if nmass != np.max(data[s:(s + self.header.npart[gfam])]):
-                                warnings.warn("Cannot write variable masses for type " + str(
-                                    gfam) + ", as masses are stored in the header.", RuntimeWarning)
-                            elif self.header.mass[gfam] != nmass:
-                                self.header.mass[gfam] = nmass
-                                self._files[i].write_header(
-                                    self.header, filename=ffile)
-                        else:
-                            # Write data
-                            if np.issubdtype(data.dtype, np.floating):
-                                data = np.asanyarray(data, dtype=np.float32)
-                            self._files[i].write_block(g_name, gfam, data[
-                                                       s:(s + f_parts[i])], filename=ffile)
-                        s += f_parts[i]
+        for fam in [fam for fam in write_fam if self._family_has_loadable_array(fam, array_name)]:
+            data = self[fam][array_name]
+            # On-disk data is single precision
+            if np.issubdtype(data.dtype, np.floating):
+                write_data = np.asanyarray(data, dtype=np.float32)
+            else:
+                write_data = data
+            s = 0
+            for gfam in gadget_type(fam):
+                # Find where each particle goes
+                f_parts = np.fromiter((f.get_block_parts(g_name, gfam) for f in self._files),
+                                      dtype=np.int64, count=nfiles)
+                offsets = s + np.concatenate(([0], np.cumsum(f_parts)))
+                s = offsets[-1]
+                # Special-case MASS.
+                if g_name == b"MASS" and self.header.mass[gfam] != 0.:
+                    for i in np.flatnonzero(f_parts):
+                        start = offsets[i]
+                        nmass = np.min(
+                            data[start:(start + self.header.npart[gfam])])
+                        # Warn if there are now different masses for this particle type,
+                        # as this information cannot be represented in this
+                        # snapshot.
+                        if nmass != np.max(data[start:(start + self.header.npart[gfam])]):
+                            warnings.warn("Cannot write variable masses for type " + str(
+                                gfam) + ", as masses are stored in the header.", RuntimeWarning)
+                        elif self.header.mass[gfam] != nmass:
+                            self.header.mass[gfam] = nmass
+                            self._files[i].write_header(
+                                self.header, filename=ffiles[i])
+                    continue
+                # Write data; the files are written concurrently
+                writes = [(self._files[i], write_data[offsets[i]:offsets[i + 1]], ffiles[i])
+                          for i in np.flatnonzero(f_parts)]
+                _map_over_files(lambda f, f_data, ffile: f.write_block(g_name, gfam, f_data, filename=ffile),
+                                writes)
 
 
 def _header_suggests_cosmological(gadget_header):
@@ -42,15 +42,15 @@ def smooth(sim):
     """Return the smoothing length array for the simulation, using the configured number of neighbours"""
     sim.build_tree()
 
-    logger.info('Smoothing with %d nearest neighbours' %
-                config['sph']['smooth-particles'])
+    nn = config['sph']['smooth-particles']
+    logger.info('Smoothing with %d nearest neighbours' % nn)
 
     sm = array.SimArray(np.empty(len(sim['pos']), dtype=sim['pos'].dtype), sim['pos'].units)
 
-    start = time.time()
+    start = time.perf_counter()
     sim.kdtree.set_array_ref('smooth', sm)
-    sim.kdtree.populate('hsm', config['sph']['smooth-particles'])
-    end = time.time()
+    sim.kdtree.populate('hsm', nn)
+    end = time.perf_counter()
 
     logger.info('Smoothing done in %5.3gs' % (end - start))
     sim._kdtree_derived_smoothing = True
@@ -79,7 +79,7 @@ def rho(sim):
         dtype=sim['pos'].dtype)
 
 
-    start = time.time()
+    start = time.perf_counter()
 
 
     sim.kdtree.set_array_ref('smooth', _get_smooth_array_ensuring_compatibility(sim))
@@ -88,7 +88,7 @@ def rho(sim):
 
     sim.kdtree.populate('rho', config['sph']['smooth-particles'])
 
-    end = time.time()
+    end = time.perf_counter()
     logger.info('Density calculation done in %5.3g s' % (end - start))
 
     return rho
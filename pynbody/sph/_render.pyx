@@ -86,6 +86,8 @@ def render_spherical_image_core(np.ndarray[fused_input_type_1, ndim=1] rho, # ar
     cdef double kernel_max_2
     cdef double physical_offset
     cdef fused_input_type_3 qty_i
+    cdef double weight_i
+    cdef image_output_type h_to_the_kdim
 
     cdef image_output_type kern
 
@@ -104,14 +106,17 @@ def render_spherical_image_core(np.ndarray[fused_input_type_1, ndim=1] rho, # ar
             angular_size = max_d_over_h * h[i] / distance
             smooth_2 = h[i]*h[i]
             kernel_max_2 = smooth_2*max_d_over_h*max_d_over_h
+            # per-particle factors, shared by every pixel the particle touches
+            h_to_the_kdim = smooth_2/distance2
+            weight_i = qty_i * mass[i] / rho[i]
 
             num_pixels = query_disc_c(nside, pos_i, angular_size, index_buffer, angle_buffer)
 
             for j in range(num_pixels):
                 physical_offset = distance * angle_buffer[j]
                 kern = get_kernel(physical_offset*physical_offset, kernel_max_2,
-                                  smooth_2/distance2, num_samples, samples_c)
-                im[index_buffer[j]] += qty_i * kern * mass[i] / rho[i]
+                                  h_to_the_kdim, num_samples, samples_c)
+                im[index_buffer[j]] += weight_i * kern
 
     return im
 
@@ -157,7 +162,13 @@ def render_image(int nx, int ny,
                  fixed_input_type z_lo, fixed_input_type z_hi,
                  fixed_input_type min_smooth,
                  kernel,
-                 wrap_offsets_x=[0], wrap_offsets_y=[0]) :
+                 wrap_offsets_x=[0], wrap_offsets_y=[0],
+                 np.ndarray[image_output_type,ndim=2] noise_result=None) :
+    """Render an SPH image of qty, returning it as an (ny, nx) array.
+
+    If noise_result is given, the image of a uniform unit quantity (i.e. mass/rho weighted kernels alone) is
+    accumulated into it in the same pass, for use in denoising. Particles with a NaN qty still contribute to
+    noise_result."""
 
     cdef fixed_input_type pixel_dx = (x2-x1)/nx
     cdef fixed_input_type pixel_dy = (y2-y1)/ny
@@ -165,10 +176,13 @@ def render_image(int nx, int ny,
     cdef fixed_input_type y_start = y1+pixel_dy/2
     cdef int n_part = len(x)
     cdef int nn=0, i=0
-    cdef fixed_input_type x_i, y_i, z_i, sm_i, qty_i
+    cdef fixed_input_type x_i, y_i, z_i, sm_i, qty_i, noise_i
     cdef fixed_input_type x_pixel, y_pixel, z_pixel
     cdef int x_pos, y_pos
     cdef int x_pix_start, x_pix_stop, y_pix_start, y_pix_stop
+    cdef image_output_type kern
+    cdef bint with_noise = noise_result is not None
+    cdef bint with_qty, with_noise_i
 
     # following are only used for "perspective" rendering
     cdef float per_z_dx = (x2-x1)/(2*z_camera)
@@ -200,6 +214,8 @@ def render_image(int nx, int ny,
 
     assert kernel_dim==2 or kernel_dim==3, "Only kernels of dimension 2 or 3 currently supported"
     assert len(x) == len(y) == len(z) == len(sm) == len(qty) == len(mass) == len(rho), "Inconsistent array lengths passed to render_image_core"
+    if with_noise:
+        assert noise_result.shape[0] == ny and noise_result.shape[1] == nx, "Noise image has the wrong shape"
 
     for wrap_offset_x in wrap_offsets_x :
         for wrap_offset_y in wrap_offsets_y :
@@ -207,14 +223,11 @@ def render_image(int nx, int ny,
                 for i in range(n_part) :
                     # load particle details
                     x_i = x[i]+wrap_offset_x; y_i=y[i]+wrap_offset_y;
-                    z_i=z[i]; sm_i = sm[i]; qty_i = qty[i]*mass[i]/rho[i]
+                    z_i=z[i]; sm_i = sm[i]
 
                     if z_i<z_lo or z_i>z_hi :
                         continue
 
-                    if qty_i!=qty_i:
-                        continue
-
                     if z_camera!=0.0 :
                         # perspective image -
                         # update image bounds for the current z
@@ -246,6 +259,15 @@ def render_image(int nx, int ny,
                             and x_i>x1-2*sm_i and x_i<x2+2*sm_i and y_i>y1-2*sm_i and y_i<y2+2*sm_i) :
                         continue
 
+                    # only weight particles that will actually be rendered; most are rejected above
+                    # in a zoomed-in image
+                    noise_i = mass[i]/rho[i]
+                    qty_i = qty[i]*noise_i
+                    with_qty = qty_i==qty_i
+                    with_noise_i = with_noise and noise_i==noise_i
+                    if not (with_qty or with_noise_i):
+                        continue
+
                     # pre-cache sm^kdim and (sm*max_d_over_h)**2; tests showed massive speedups when doing this
                     if kernel_dim==2 :
                         sm_to_kdim = sm_i*sm_i
@@ -267,7 +289,11 @@ def render_image(int nx, int ny,
 
                         # final bounds check
                         if x_pos>=0 and x_pos<nx and y_pos>=0 and y_pos<ny :
-                            result[y_pos,x_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                            kern = get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                            if with_qty:
+                                result[y_pos,x_pos]+=qty_i*kern
+                            if with_noise_i:
+                                noise_result[y_pos,x_pos]+=noise_i*kern
                     else :
                         # multi-pixel
                         x_pix_start = int((x_i-max_d_over_h*sm_i-x1)/pixel_dx)
@@ -297,7 +323,11 @@ def render_image(int nx, int ny,
 
                                 #c_result[x_pos+nx*y_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
 
-                                result[y_pos,x_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                                kern = get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                                if with_qty:
+                                    result[y_pos,x_pos]+=qty_i*kern
+                                if with_noise_i:
+                                    noise_result[y_pos,x_pos]+=noise_i*kern
 
     return result
 
@@ -355,8 +385,7 @@ def to_3d_grid(int nx, int ny, int nz,
     cdef float wrap_offset_x, wrap_offset_y, wrap_offset_z
 
     if kernel_dim<3:
-        raise ValueError, \
-          "Cannot render to 3D grid without 3-dimensional kernel or greater"
+        raise ValueError("Cannot render to 3D grid without 3-dimensional kernel or greater")
 
     assert len(x) == len(y) == len(z) == len(sm) == \
             len(qty) == len(mass) == len(rho), \
@@ -370,7 +399,6 @@ def to_3d_grid(int nx, int ny, int nz,
                         # load particle details
                         x_i = x[i]+wrap_offset_x; y_i=y[i]+wrap_offset_y; z_i=z[i]+wrap_offset_z
                         sm_i = sm[i]
-                        qty_i = qty[i]*mass[i]/rho[i]
 
                         # check particle smoothing is within specified range
                         if sm_i<pixel_dx*smooth_lo or sm_i>pixel_dx*smooth_hi : continue
@@ -383,6 +411,8 @@ def to_3d_grid(int nx, int ny, int nz,
                                 and y_i>y1-2*sm_i and y_i<y2+2*sm_i) :
                             continue
 
+                        qty_i = qty[i]*mass[i]/rho[i]
+
                         # pre-cache sm^kdim and (sm*max_d_over_h)**2; tests showed massive speedups when doing this
                         if kernel_dim==2 :
                             sm_to_kdim = sm_i*sm_i
@@ -432,3 +462,43 @@ def to_3d_grid(int nx, int ny, int nz,
                                         result[x_pos,y_pos,z_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel), kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
 
     return result
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def add_upsampled_image(np.ndarray[image_output_type, ndim=2] target,
+                        np.ndarray[image_output_type, ndim=2] source):
+    """Bilinearly interpolate source onto the pixel grid of target, and add the result to target in place.
+
+    The outer pixel edges of the two images are aligned and source is taken to be zero outside its bounds, i.e.
+    this is equivalent to ``target += scipy.ndimage.zoom(source, ..., order=1, grid_mode=True,
+    mode='grid-constant')`` but without allocating the zoomed image."""
+    cdef Py_ssize_t ny = target.shape[0], nx = target.shape[1]
+    cdef Py_ssize_t sy = source.shape[0], sx = source.shape[1]
+    cdef double scale_y = <double>sy / ny, scale_x = <double>sx / nx
+    cdef Py_ssize_t i, j, i0, j0
+    cdef double pos, wy, wx, row0, row1
+
+    with nogil:
+        for i in range(ny):
+            pos = (i + 0.5) * scale_y - 0.5
+            i0 = <Py_ssize_t> cmath.floor(pos)
+            wy = pos - i0
+            for j in range(nx):
+                pos = (j + 0.5) * scale_x - 0.5
+                j0 = <Py_ssize_t> cmath.floor(pos)
+                wx = pos - j0
+                row0 = 0.0
+                row1 = 0.0
+                if j0 >= 0:
+                    if i0 >= 0:
+                        row0 = (1.0 - wx) * source[i0, j0]
+                    if i0 + 1 < sy:
+                        row1 = (1.0 - wx) * source[i0 + 1, j0]
+                if j0 + 1 < sx:
+                    if i0 >= 0:
+                        row0 = row0 + wx * source[i0, j0 + 1]
+                    if i0 + 1 < sy:
+                        row1 = row1 + wx * source[i0 + 1, j0 + 1]
+                target[i, j] += <image_output_type> ((1.0 - wy) * row0 + wy * row1)
@@ -3,7 +3,9 @@
 from __future__ import annotations
 
 import numpy as np
-import scipy.integrate as integrate
+
+# Values of (displacement / smoothing)^2 at which kernels are tabulated for the C renderers
+_SAMPLE_POINTS = np.arange(0, 4.01, 0.02)
 
 
 class KernelBase:
@@ -21,21 +23,18 @@ class KernelBase:
         # The maximum value of the displacement over the smoothing for
         # which the kernel is non-zero
 
-    def _get_samples_from_cache(self):
-        if hash(self) in KernelBase._sample_cache:
-            return KernelBase._sample_cache[hash(self)]
-        else:
-            return None
+    def _get_samples_from_cache(self, dtype):
+        return KernelBase._sample_cache.get((hash(self), np.dtype(dtype)), None)
 
     def get_samples(self, dtype=np.float32):
-        import time
-        s = time.time()
+        """Return a table of kernel values, sampled uniformly in the square of the displacement over the smoothing.
 
-        samples = self._get_samples_from_cache()
+        Tables are cached per kernel type and dtype, and shared between instances; the built-in kernels
+        have their single-precision tables computed at import."""
+        samples = self._get_samples_from_cache(dtype)
         if samples is None:
-            sample_pts = np.arange(0, 4.01, 0.02)
-            samples = np.array([self.get_value(x ** 0.5) for x in sample_pts], dtype=dtype)
-            KernelBase._sample_cache[hash(self)] = samples
+            samples = self.get_values(np.sqrt(_SAMPLE_POINTS)).astype(dtype)
+            KernelBase._sample_cache[(hash(self), np.dtype(dtype))] = samples
 
         return samples
 
@@ -43,6 +42,13 @@ class KernelBase:
         """Get the value of the kernel for a given smoothing length."""
         raise NotImplementedError("Subclasses must implement this method")
 
+    def get_values(self, d, h=1) -> np.ndarray:
+        """Get the value of the kernel for an array of displacements, for a given smoothing length.
+
+        Subclasses should override this with a vectorised implementation; by default, get_value is called
+        for each element in turn."""
+        return np.vectorize(self.get_value, otypes=[np.float64])(d, h)
+
     def projection(self) -> KernelBase:
         """Return a 2D projection of this kernel"""
         return Kernel2D(self)
@@ -61,12 +67,12 @@ class KernelBase:
 class CubicSplineKernel(KernelBase):
     """A cubic spline kernel. This is the default kernel used by pynbody."""
     def get_value(self, d, h=1):
-        if d < 1:
-            f = 1. - (3. / 2) * d ** 2 + (3. / 4.) * d ** 3
-        elif d < 2:
-            f = 0.25 * (2. - d) ** 3
-        else:
-            f = 0
+        return float(self.get_values(d, h))
+
+    def get_values(self, d, h=1):
+        d = np.asarray(d, dtype=np.float64)
+        f = np.where(d < 1, 1. - (3. / 2) * d ** 2 + (3. / 4.) * d ** 3,
+                     0.25 * np.maximum(2. - d, 0) ** 3)
 
         return f / (np.pi * h ** 3)
 
@@ -78,10 +84,11 @@ class WendlandC2Kernel(KernelBase):
     """A Wendland C2 (quintic) kernel. This is the default kernel used by EAGLE."""
 
     def get_value(self, d, h=1):
-        if d < 2:
-            f = (1. - (d / 2.))**4 * (2. * d + 1)
-        else:
-            f = 0
+        return float(self.get_values(d, h))
+
+    def get_values(self, d, h=1):
+        d = np.asarray(d, dtype=np.float64)
+        f = np.maximum(1. - (d / 2.), 0)**4 * (2. * d + 1)
 
         return (21. * f) / (16. * np.pi * h ** 3)
 
@@ -92,6 +99,10 @@ class WendlandC2Kernel(KernelBase):
 
 class Kernel2D(KernelBase):
     """A 2D spline kernel, generated by numerically projecting an underlying 3D kernel"""
+
+    # Gauss-Legendre nodes and weights on [-1, 1], applied to each piece of the line-of-sight integral
+    _quadrature_nodes, _quadrature_weights = np.polynomial.legendre.leggauss(32)
+
     def __init__(self, k_orig=CubicSplineKernel()):
         """Create a 2D kernel by projecting a 3D kernel. The 3D kernel is passed as an argument."""
         self.h_power = 2
@@ -102,7 +113,22 @@ class Kernel2D(KernelBase):
         raise ValueError("Cannot project a 2D kernel")
 
     def get_value(self, d, h=1):
-        return 2 * integrate.quad(lambda z: self.k_orig.get_value(np.sqrt(z ** 2 + d ** 2), h), 0, 2*h)[0]
+        return float(self.get_values(d, h))
+
+    def get_values(self, d, h=1):
+        d = np.asarray(d, dtype=np.float64)[..., np.newaxis]
+        z_max = self.max_d * h
+        # Split the line of sight wherever it crosses an integer radius, since the underlying kernels are
+        # only piecewise smooth there, and integrate each piece with fixed-order quadrature
+        radii = np.arange(1, np.ceil(self.max_d) + 1)
+        z_breaks = np.sort(np.concatenate((np.zeros_like(d), np.full_like(d, z_max),
+                                           np.clip(np.sqrt(np.maximum(radii ** 2 - d ** 2, 0)), 0, z_max)),
+                                          axis=-1), axis=-1)
+        z_lo, z_hi = z_breaks[..., :-1, np.newaxis], z_breaks[..., 1:, np.newaxis]
+        half_width = 0.5 * (z_hi - z_lo)
+        z = z_lo + half_width * (self._quadrature_nodes + 1)
+        vals = self.k_orig.get_values(np.sqrt(z ** 2 + d[..., np.newaxis] ** 2), h)
+        return 2 * (half_width * vals * self._quadrature_weights).sum(axis=(-2, -1))
 
     def get_c_kernel_id(self):
         raise NotImplementedError("2D kernels are not supported in C")
@@ -111,6 +137,12 @@ class Kernel2D(KernelBase):
         return hash((self.__class__, self.k_orig))
 
 
+for _kernel in (CubicSplineKernel(), WendlandC2Kernel()):
+    _kernel.get_samples()
+    _kernel.projection().get_samples()
+del _kernel
+
+
 def create_kernel(spec) -> KernelBase:
     """Create a kernel object from a string specification, a type, an existing kernel object, or a None
 
@@ -9,15 +9,14 @@ For complete control, one may use the :class:`ImageRenderer` class directly.
 
 from __future__ import annotations
 
-import concurrent
-import concurrent.futures
 import copy
+import functools
 from types import NoneType
 
 import numpy as np
 import scipy
 
-from .. import array as array_module, config, snapshot, units
+from .. import array as array_module, config, snapshot, units, util
 from ..configuration import config_parser, logger
 from . import _render, kernels
 
@@ -38,6 +37,30 @@ def _auto_denoise(sim, kernel):
     else:
         return False
 
+# Unit arithmetic is slow compared with rendering a small image, and the same combinations recur on every
+# render (and on every thread of a threaded render), so the results are memoized. Units hash by identity,
+# so these caches only hit when the same unit objects are passed again, which is the case for a
+# snapshot's arrays.
+@functools.lru_cache(maxsize=128)
+def _unit_power(unit, power):
+    return unit ** power
+
+@functools.lru_cache(maxsize=128)
+def _native_output_units(array_units, mass_units, rho_units, area_units):
+    return array_units * mass_units / (rho_units * area_units)
+
+@functools.lru_cache(maxsize=128)
+def _units_ratio(from_units, to_units, conversion_context):
+    return from_units.ratio(to_units, **dict(conversion_context))
+
+def _sum_in_place(images):
+    """Sum a list of images by accumulating into the first, which is returned."""
+    summed = images[0]
+    summed_ndarray = summed.view(np.ndarray)
+    for image in images[1:]:
+        summed_ndarray += image.view(np.ndarray)
+    return summed
+
 class RenderPipelineLogicError(RuntimeError):
     pass
 
@@ -334,6 +357,16 @@ class ImageRendererBase:
         """Render the image and return it as a numpy array or SimArray."""
         raise NotImplementedError("Subclasses must implement this method")
 
+    def _can_render_noise_field(self) -> bool:
+        """Return True if this renderer implements _render_with_noise_field."""
+        return False
+
+    def _render_with_noise_field(self) -> tuple[np.ndarray, np.ndarray]:
+        """Render the image together with the image of a uniform unit quantity, in a single pass.
+
+        The second image is the noise field used for denoising; see :class:`DenoisedImageRenderer`."""
+        raise NotImplementedError("This renderer cannot render a noise field in the same pass as the image")
+
 
     def with_denoising(self, denoise : bool | NoneType = None) -> ImageRendererBase:
         """Return a version of this renderer that may inclue a denoising step.
@@ -491,7 +524,11 @@ class DenoisedImageRenderer(MultipassImageRenderer):
         self._subrenderers[1].set_output_units(None)
 
     def render(self):
-        result_source_field, result_noise_field = super().render()
+        if self._subrenderers[0]._can_render_noise_field():
+            # the noise field comes from the same particle loop as the image, using only the first subrenderer
+            result_source_field, result_noise_field = self._subrenderers[0]._render_with_noise_field()
+        else:
+            result_source_field, result_noise_field = super().render()
         return result_source_field / result_noise_field
 
     def set_output_units(self, units_: str | units.UnitBase):
@@ -557,16 +594,25 @@ class ThreadedImageRenderer(MultipassImageRenderer):
         """Create a threaded image renderer, rendering the image across the specified number of threads."""
         super().__init__(base, num_threads, share_geometry = True)
         self._num_threads = num_threads
-        for i, r in enumerate(self._subrenderers):
-            # render every num_threads particle, starting at i
-            r.set_particle_array_slice(slice(i, None, num_threads))
+        # each thread renders a contiguous block of particles, so that it streams through its own part
+        # of the particle arrays rather than sharing every cache line with the other threads
+        boundaries = np.linspace(0, len(self._snapshot), num_threads + 1).astype(np.intp)
+        for r, start, end in zip(self._subrenderers, boundaries[:-1], boundaries[1:]):
+            r.set_particle_array_slice(slice(start, end))
 
     def render(self):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self._subrenderers)) as executor:
-            # logger.info("Rendering image on %d threads..." % self._num_threads)
-            results = executor.map(lambda r: r.render(), self._subrenderers)
+        # logger.info("Rendering image on %d threads..." % self._num_threads)
+        results = util.thread_map(lambda r: r.render(), self._subrenderers)
+
+        return _sum_in_place(results)
 
-        return sum(results)
+    def _can_render_noise_field(self):
+        return self._subrenderers[0]._can_render_noise_field()
+
+    def _render_with_noise_field(self):
+        results = util.thread_map(lambda r: r._render_with_noise_field(), self._subrenderers)
+        images, noise_images = zip(*results)
+        return _sum_in_place(images), _sum_in_place(noise_images)
 
 
 class ApproximateImageRenderer(MultipassImageRenderer):
@@ -601,18 +647,41 @@ class ApproximateImageRenderer(MultipassImageRenderer):
             zoomed_images.append(zoomed_result)
         return zoomed_images
 
-    def render(self):
-        results = self._apply_zoom(super().render())
-        summed = sum(results)
+    def _combine_levels(self, images):
+        """Sum the images rendered at each level, upsampling them to the resolution of the first."""
+        if images[0].ndim != 2:
+            # e.g. 3d grids, which the in-place upsampler does not handle
+            return _sum_in_place(self._apply_zoom(images))
+
+        # Accumulate each lower-resolution level straight into the full-resolution image, rather than
+        # allocating a zoomed copy of each
+        summed = images[0]
+        for image in images[1:]:
+            _render.add_upsampled_image(summed, image.view(np.ndarray))
         return summed
 
+    def render(self):
+        return self._combine_levels(super().render())
+
+    def _can_render_noise_field(self):
+        return all(r._can_render_noise_field() for r in self._subrenderers)
+
+    def _render_with_noise_field(self):
+        images, noise_images = zip(*[r._render_with_noise_field() for r in self._subrenderers])
+        return self._combine_levels(images), self._combine_levels(noise_images)
+
 class ImageRenderer(ImageRendererBase):
     """Implementation for rendering a simulation snapshot to 2d image"""
 
     def _calculate_wrapping_repeat_array(self, x1, x2):
         if 'boxsize' in self._snapshot.properties:
-            boxsize = self._snapshot.properties['boxsize'].in_units(self._snapshot['pos'].units,
-                                                                    **self._snapshot.conversion_context())
+            boxsize = self._snapshot.properties['boxsize']
+            if isinstance(boxsize, units.UnitBase):
+                # memoized, since this is needed for every axis of every render
+                boxsize = _units_ratio(boxsize, self._snapshot['pos'].units,
+                                       tuple(self._snapshot.conversion_context().items()))
+            else:
+                boxsize = boxsize.in_units(self._snapshot['pos'].units, **self._snapshot.conversion_context())
         else:
             boxsize = None
 
@@ -631,7 +700,7 @@ class ImageRenderer(ImageRendererBase):
             else:
                 kernel_h_power = 3
 
-        return smooth.units ** kernel_h_power
+        return _unit_power(smooth.units, kernel_h_power)
 
     def _get_native_output_units(self, array, mass, rho, smooth) -> units.UnitBase:
         if hasattr(array, 'units'):
@@ -639,11 +708,20 @@ class ImageRenderer(ImageRendererBase):
         else:
             array_units = 1.0
 
-        native_units = array_units * mass.units / (rho.units * self._get_native_area_unit(smooth))
+        native_units = _native_output_units(array_units, mass.units, rho.units, self._get_native_area_unit(smooth))
 
         return native_units
 
     def render(self):
+        return self._render(with_noise_field=False)
+
+    def _can_render_noise_field(self):
+        return True
+
+    def _render_with_noise_field(self):
+        return self._render(with_noise_field=True)
+
+    def _render(self, with_noise_field):
         kernel = kernels.create_kernel(self._kernel)
 
         if self._is_projected:
@@ -664,15 +742,23 @@ class ImageRenderer(ImageRendererBase):
         native_units = self._get_native_output_units(array, mass, rho, smooth)
 
         if self._out_units is not None:
-            conversion = native_units.ratio(self._out_units, **self._snapshot.conversion_context())
+            conversion = _units_ratio(native_units, self._out_units,
+                                      tuple(self._snapshot.conversion_context().items()))
             out_units = self._out_units
         else:
             conversion = 1.0
             out_units = native_units
 
+        if with_noise_field:
+            # the same as the native units of a render of a dimensionless array of ones
+            noise_units = _native_output_units(1.0, mass.units, rho.units, self._get_native_area_unit(smooth))
+
         smooth, array, mass, rho = (q.view(np.ndarray) for q in (smooth, array, mass, rho))
 
-        image = self._call_c_renderer(array, g, kernel, mass, rho, smooth, x, y, z)
+        if with_noise_field:
+            image, noise_image = self._call_c_renderer_with_noise_field(array, g, kernel, mass, rho, smooth, x, y, z)
+        else:
+            image = self._call_c_renderer(array, g, kernel, mass, rho, smooth, x, y, z)
 
         if conversion != 1.0:
             image *= conversion
@@ -681,17 +767,32 @@ class ImageRenderer(ImageRendererBase):
         image.sim = self._snapshot
         image.units = out_units
 
+        if with_noise_field:
+            noise_image = noise_image.view(array_module.SimArray)
+            noise_image.sim = self._snapshot
+            noise_image.units = noise_units
+            return image, noise_image
+
         return image
 
-    def _call_c_renderer(self, array, geometry, kernel, mass_array, rho_array, smooth_array, x_array, y_array, z_array):
+    def _call_c_renderer(self, array, geometry, kernel, mass_array, rho_array, smooth_array, x_array, y_array, z_array,
+                         noise_image=None):
         image = _render.render_image(geometry.nx, geometry.ny, x_array, y_array, z_array, smooth_array, geometry.x1, geometry.x2, geometry.y1, geometry.y2,
                                      geometry.z_camera or 0.0, geometry.z_plane, array, mass_array, rho_array,
                                      self._smooth_min, self._smooth_max, geometry.z1, geometry.z2,
                                      self._smooth_floor, kernel,
                                      self._calculate_wrapping_repeat_array(geometry.x1, geometry.x2),
-                                     self._calculate_wrapping_repeat_array(geometry.y1, geometry.y2))
+                                     self._calculate_wrapping_repeat_array(geometry.y1, geometry.y2),
+                                     noise_image)
         return image
 
+    def _call_c_renderer_with_noise_field(self, array, geometry, kernel, mass_array, rho_array, smooth_array,
+                                          x_array, y_array, z_array):
+        noise_image = np.zeros((geometry.ny, geometry.nx), dtype=np.float32)
+        image = self._call_c_renderer(array, geometry, kernel, mass_array, rho_array, smooth_array,
+                                      x_array, y_array, z_array, noise_image)
+        return image, noise_image
+
 
 class Grid3dRenderer(ImageRenderer):
     """Implementation for rendering a simulation snapshot to a 3d grid"""
@@ -704,6 +805,9 @@ class Grid3dRenderer(ImageRenderer):
         super().set_width(width)
         self.geometry.restrict_z_range() # sets z1, z2 - here this is for the grid edges, not the camera
 
+    def _can_render_noise_field(self):
+        return False
+
     def _call_c_renderer(self, array, geometry, kernel, mass_array, rho_array, smooth_array, x_array, y_array, z_array):
         image = _render.to_3d_grid(geometry.nx, geometry.ny, geometry.nz, x_array, y_array, z_array,
                                    smooth_array, geometry.x1, geometry.x2, geometry.y1, geometry.y2, geometry.z1, geometry.z2,
@@ -727,6 +831,9 @@ class HealpixRenderer(ImageRenderer):
         else:
             return super()._get_native_area_unit(smooth, kernel_h_power)
 
+    def _can_render_noise_field(self):
+        return False
+
     def _call_c_renderer(self, array, geometry, kernel, mass_array, rho_array, smooth_array, x_array, y_array, z_array):
         return _render.render_spherical_image_core(rho_array, mass_array, array,
                                                    x_array, y_array, z_array,
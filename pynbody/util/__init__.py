@@ -4,13 +4,13 @@ Routines used internally by pynbody.
 """
 from __future__ import annotations
 
+import concurrent.futures
 import fractions
 import functools
 import gzip
 import logging
 import math
 import pathlib
-import sys
 import threading
 import warnings
 
@@ -462,41 +462,52 @@ def gamma_inc(a, z, eps=3.e-7):
 
 
 
+_thread_pool = None
+_thread_pool_size = 0
+_thread_pool_lock = threading.Lock()
+_thread_pool_state = threading.local()
+
+
+def _get_thread_pool(min_workers):
+    """Return the shared thread pool used by :func:`thread_map`, enlarging it if it has fewer than min_workers"""
+    global _thread_pool, _thread_pool_size
+    with _thread_pool_lock:
+        if _thread_pool is None or _thread_pool_size < min_workers:
+            from ..configuration import config
+            # Any previous, smaller pool is simply dropped; its idle workers exit once it is garbage collected
+            _thread_pool_size = max(min_workers, config['number_of_threads'])
+            _thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=_thread_pool_size,
+                                                                 thread_name_prefix='pynbody')
+        return _thread_pool
+
+
 def thread_map(func, *args):
     """Run func in separate threads, mapping over the arguments in the same way as map(...)
 
-    This does not use a thread pool. A new thread is created for each function call.
+    The calls are dispatched to a persistent thread pool, which is shared between calls and grown if
+    necessary so that every call runs concurrently. If thread_map is itself called from within one of
+    the pool's threads, the calls are instead made in turn on that thread, so that nested use cannot
+    exhaust the pool.
 
     This routine is used by :mod:`pynbody.kdtree`.
     """
 
-    def r_func(*afunc):
-        try:
-            this_t = threading.current_thread()
-            this_t.ret_value = func(*afunc)
-        except Exception as e:
-            this_t.ret_excp = sys.exc_info()
-
-    threads = []
-    for arg_this in zip(*args):
-        threads.append(threading.Thread(target=r_func, args=arg_this))
-        threads[-1].start()
-    rets = []
-    excp = None
-    for t in threads:
-        while t.is_alive():
-            # just calling t.join() with no timeout can make it harder to
-            # debug deadlocks!
-            t.join(1.0)
-        if hasattr(t, 'ret_excp'):
-            _, excp, trace = t.ret_excp
-        else:
-            rets.append(t.ret_value)
+    arg_tuples = list(zip(*args))
 
-    if excp is None:
-        return rets
-    else:
-        raise excp.with_traceback(trace)  # Note this is a re-raised exception from within a thread
+    if getattr(_thread_pool_state, 'in_pool', False):
+        return [func(*a) for a in arg_tuples]
+
+    def r_func(a):
+        _thread_pool_state.in_pool = True
+        try:
+            return func(*a)
+        finally:
+            _thread_pool_state.in_pool = False
+
+    pool = _get_thread_pool(len(arg_tuples))
+    futures = [pool.submit(r_func, a) for a in arg_tuples]
+    concurrent.futures.wait(futures)
+    return [f.result() for f in futures]
 
 
 def deprecated(func, message=None):
@@ -133,9 +133,13 @@ cython_fortran_file = Extension('pynbody.extern._cython_fortran_utils',
                                 sources=['pynbody/extern/_cython_fortran_utils.pyx'],
                                 include_dirs=incdir)
 
+gadget_io = Extension('pynbody.snapshot._gadget_io',
+                      sources=['pynbody/snapshot/_gadget_io.pyx'],
+                      include_dirs=incdir)
+
 
 ext_modules += [gravity, chunkscan, sph_render, halo_pyx, bridge_pyx, util_pyx, filt_geom_pyx,
-                cython_fortran_file, omp_commands]
+                cython_fortran_file, gadget_io, omp_commands]
 
 install_requires = [
     'cython>=0.20',
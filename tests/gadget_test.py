@@ -1,9 +1,18 @@
+import errno
+import functools
+import mmap
+import os
+import re
+import struct
+import warnings
+
 import numpy as np
 import numpy.testing as npt
 import pytest
 
 import pynbody
 import pynbody.test_utils
+from pynbody.snapshot import _gadget_io, gadget
 
 
 @pytest.fixture(scope='module', autouse=True)
@@ -225,3 +234,336 @@ def test_ignore_cosmology():
     np.testing.assert_allclose(f.properties['time'].in_units('Gyr'), 2.57689526)
     f_no_cosmo = pynbody.load("testdata/gadget2/test_g2_snap.1", ignore_cosmo=True)
     np.testing.assert_allclose(f_no_cosmo.properties['time'].in_units('Gyr'), 271.608952)
+
+
+_GADGET_HEADER = "IIIIIIddddddddiiIIIIIIiiddddiiIIIIIIiiif48s"
+
+
+def _gadget_record(endian, name, payload, format2):
+    """Return payload as a Fortran record, preceded by a format-2 name record if required"""
+    out = b""
+    if format2:
+        out += struct.pack(endian + "I4sII", 8, name, len(payload) + 8, 8)
+    return out + struct.pack(endian + "I", len(payload)) + payload + struct.pack(endian + "I", len(payload))
+
+
+def _make_gadget_snap(filename, num_files=1, format2=True, endian="=", pos_type=np.float32, id_type=np.int32,
+                      gas_blocks=(b"U   ",), npart=(10, 20, 5), seed=1):
+    """Write a small synthetic gadget snapshot of gas, dark matter and star particles, split over num_files files.
+    The i-th file holds npart gas, dark matter and star particles respectively, plus i, 3i and i more.
+
+    Each file holds POS, VEL, ID and MASS blocks, followed by a float32 block for the gas for each name in
+    gas_blocks. Format-1 files are written in the same order, so that names are assigned from the default
+    gadget-1-blocks list and any records beyond its end are given fallback names."""
+    rng = np.random.default_rng(seed)
+    npart_per_file = [np.array([npart[0] + i, npart[1] + 3 * i, 0, 0, npart[2] + i, 0], dtype=np.uint32)
+                      for i in range(num_files)]
+    nall = sum(npart_per_file)
+    mass = [0.0, 0.25, 0.0, 0.0, 0.0, 0.0]
+    first_id = 0
+    for i, file_npart in enumerate(npart_per_file):
+        n = int(file_npart.sum())
+        header = struct.pack(endian + _GADGET_HEADER, *file_npart, *mass, 0.5, 1.0, 1, 0, *nall, 1, num_files,
+                             1000.0, 0.3, 0.7, 0.7, 1, 1, *([0] * 6), 0, 0, 0, 0.0, b"\0" * 48)
+        blocks = [(b"POS ", rng.random((n, 3)).astype(pos_type)),
+                  (b"VEL ", rng.random((n, 3)).astype(pos_type)),
+                  (b"ID  ", np.arange(first_id, first_id + n, dtype=id_type)),
+                  (b"MASS", rng.random(int(file_npart[0] + file_npart[4])).astype(np.float32))]
+        blocks += [(name, rng.random(int(file_npart[0])).astype(np.float32)) for name in gas_blocks]
+        first_id += n
+        with open(filename if num_files == 1 else filename + "." + str(i), "wb") as f:
+            f.write(_gadget_record(endian, b"HEAD", header, format2))
+            for name, data in blocks:
+                f.write(_gadget_record(endian, name, data.astype(data.dtype.newbyteorder(endian)).tobytes(), format2))
+
+
+def _python_scan_blocks(gadget_file, buf, offset, first_name, t_part):
+    """Walk the block table one record at a time in Python, as _GadgetFile did before scan_blocks existed"""
+    gadget_file._blk_idx = first_name
+    gadget_file.extra = 0
+    blocks = []
+    while True:
+        (name, length, offset) = gadget_file.read_block_head(buf, offset)
+        if length == 0:
+            break
+        if name[0:4] == b"POS " or name[0:4] == b"VEL ":
+            partlen = 24 if length == t_part * 24 else 12
+        elif name[0:4] == b"ID  ":
+            partlen = 4 if length == t_part * 4 else 8
+        else:
+            partlen = 0
+        start = offset
+        extra_len = t_part * partlen
+        offset += extra_len if extra_len >= 2 ** 32 else length
+        (record_size, offset) = gadget_file.read_block_foot(buf, offset)
+        assert record_size == length
+        if extra_len >= 2 ** 32:
+            length = extra_len
+        blocks.append((name[0:4], start, length, partlen))
+    return blocks, gadget_file.extra
+
+
+@pytest.mark.parametrize(("format2", "endian", "pos_type", "id_type", "gas_blocks"), [
+    (True, "=", np.float32, np.int32, (b"U   ", b"RHO ")),
+    (True, ">", np.float64, np.int64, (b"U   ",)),
+    (False, "=", np.float32, np.int64, (b"U   ", b"NH  ", b"NHE ", b"HSML", b"SFR ", b"X1  ", b"X2  ")),
+    (False, ">", np.float64, np.int32, (b"U   ",)),
+])
+def test_scan_blocks(tmp_path, format2, endian, pos_type, id_type, gas_blocks):
+    """Check the compiled block table scan agrees with the original Python one"""
+    filename = str(tmp_path / "snap")
+    _make_gadget_snap(filename, format2=format2, endian=endian, pos_type=pos_type, id_type=id_type,
+                      gas_blocks=gas_blocks)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        f = gadget._GadgetFile(filename)
+    with open(filename, "rb") as fd:
+        buf = fd.read()
+
+    # The records following HEAD start after its name record (format 2 only), markers and 256-byte body
+    offset = 16 * format2 + 264
+    first_name = f._blk_idx
+    t_part = int(f.header.npart.sum())
+    block_names = f.block_names if not format2 else []
+    scanned = _gadget_io.scan_blocks(buf, offset, format2, endian != "=", block_names, first_name, t_part,
+                                     filename)
+    n_fallback_names = f.extra
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        expected = _python_scan_blocks(f, buf, offset, first_name, t_part)
+
+    assert scanned == expected
+    assert n_fallback_names == expected[1] == (2 if len(gas_blocks) > 5 else 0)
+    assert f.blocks[b"POS "].partlen == np.dtype(pos_type).itemsize * 3
+    assert f.blocks[b"POS "].data_type == pos_type
+    assert f.blocks[b"ID  "].data_type == id_type
+    if n_fallback_names:
+        assert b"UNK0" in f.blocks and b"UNK1" in f.blocks
+
+
+@pytest.mark.parametrize("format2", [True, False])
+def test_scan_blocks_corrupt_footer(tmp_path, format2):
+    filename = str(tmp_path / "snap")
+    _make_gadget_snap(filename, format2=format2)
+    with open(filename, "r+b") as f:
+        f.seek(-4, 2)
+        f.write(struct.pack("I", 12345))
+    with pytest.raises(OSError, match="Corrupt record in " + re.escape(filename) + " footer"):
+        gadget._GadgetFile(filename)
+
+
+def test_scan_blocks_corrupt_header(tmp_path):
+    filename = str(tmp_path / "snap")
+    _make_gadget_snap(filename)
+    with open(filename, "r+b") as f:
+        # The first marker of the POS name record, which follows the HEAD block
+        f.seek(280)
+        f.write(struct.pack("I", 9))
+    with pytest.raises(OSError, match="Corrupt header record in " + re.escape(filename)):
+        gadget._GadgetFile(filename)
+
+
+def _compare_with_buffered_load(filename, snap, keys=("pos", "vel", "iord", "mass")):
+    """Check the arrays of snap match those from loading filename with the default I/O settings"""
+    # Load everything from snap first, so that its reads are done with the settings under test
+    arrays = [snap[key] for key in keys] + [snap.gas["u"]]
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(gadget, "_direct_io", False)
+        mp.setattr(gadget, "_mmap_arrays", False)
+        reference = pynbody.load(filename)
+        for array, expected in zip(arrays, [reference[key] for key in keys] + [reference.gas["u"]]):
+            npt.assert_array_equal(array, expected)
+
+
+@pytest.fixture
+def direct_io(monkeypatch):
+    """Route every block read through _read_direct, recording what each call returned"""
+    results = []
+    read_direct = gadget._read_direct
+
+    def recording_read_direct(*args, **kwargs):
+        data = read_direct(*args, **kwargs)
+        results.append(data)
+        return data
+
+    monkeypatch.setattr(gadget, "_direct_io", True)
+    monkeypatch.setattr(gadget, "_direct_io_min_bytes", 1)
+    monkeypatch.setattr(gadget, "_read_direct", recording_read_direct)
+    return results
+
+
+def _skip_without_direct_io(filename):
+    try:
+        os.close(os.open(filename, os.O_RDONLY | os.O_DIRECT))
+    except OSError as error:
+        if error.errno == errno.EINVAL:
+            pytest.skip("O_DIRECT is not supported by the filesystem holding the test files")
+        raise
+
+
+@pytest.mark.skipif(not hasattr(os, "O_DIRECT"), reason="O_DIRECT is not available on this platform")
+def test_direct_io_unaligned(tmp_path, direct_io):
+    filename = str(tmp_path / "snap")
+    _make_gadget_snap(filename, num_files=2)
+    _skip_without_direct_io(filename + ".0")
+    snap = pynbody.load(filename)
+    assert any(block.start % mmap.PAGESIZE for block in snap._files[0].blocks.values())
+    _compare_with_buffered_load(filename, snap)
+    assert len(direct_io) > 0 and all(data is not None for data in direct_io)
+
+
+@pytest.mark.skipif(not hasattr(os, "O_DIRECT"), reason="O_DIRECT is not available on this platform")
+def test_direct_io_chunked(tmp_path, monkeypatch, direct_io):
+    filename = str(tmp_path / "snap")
+    _make_gadget_snap(filename, npart=(400, 800, 100))
+    _skip_without_direct_io(filename)
+    # The POS and VEL blocks each span several chunks
+    monkeypatch.setattr(gadget, "_read_direct", functools.partial(gadget._read_direct, chunk_size=mmap.PAGESIZE))
+    n_calls = []
+    preadv = os.preadv
+    monkeypatch.setattr(os, "preadv", lambda *args: n_calls.append(1) or preadv(*args))
+    snap = pynbody.load(filename)
+    assert snap._files[0].blocks[b"POS "].length > 3 * mmap.PAGESIZE
+    _compare_with_buffered_load(filename, snap)
+    assert len(n_calls) > len(direct_io) > 0
+    assert all(data is not None for data in direct_io)
+
+
+@pytest.mark.skipif(not hasattr(os, "O_DIRECT"), reason="O_DIRECT is not available on this platform")
+def test_direct_io_fallback(tmp_path, monkeypatch, direct_io):
+    filename = str(tmp_path / "snap")
+    _make_gadget_snap(filename, num_files=2)
+    os_open = os.open
+
+    def refuse_direct_io(path, flags, *args, **kwargs):
+        if flags & os.O_DIRECT:
+            raise OSError(errno.EINVAL, "Invalid argument", path)
+        return os_open(path, flags, *args, **kwargs)
+
+    monkeypatch.setattr(os, "open", refuse_direct_io)
+    snap = pynbody.load(filename)
+    _compare_with_buffered_load(filename, snap)
+    assert len(direct_io) > 0 and all(data is None for data in direct_io)
+
+
+def _is_memory_mapped(array):
+    while array is not None:
+        if isinstance(array, mmap.mmap):
+            return True
+        array = array.obj if isinstance(array, memoryview) else getattr(array, "base", None)
+    return False
+
+
+@pytest.mark.parametrize(("num_files", "endian"), [(1, "="), (2, "="), (1, ">")])
+def test_mmap_arrays(tmp_path, monkeypatch, num_files, endian):
+    """Check mmap-arrays gives the same arrays as a normal load, mapping them where the file allows it"""
+    filename = str(tmp_path / "snap")
+    _make_gadget_snap(filename, num_files=num_files, endian=endian)
+    monkeypatch.setattr(gadget, "_mmap_arrays", True)
+    snap = pynbody.load(filename)
+    _compare_with_buffered_load(filename, snap)
+    assert _is_memory_mapped(snap["pos"]) == (num_files == 1 and endian == "=")
+
+
+def test_mmap_arrays_family(tmp_path, monkeypatch):
+    filename = str(tmp_path / "snap")
+    _make_gadget_snap(filename)
+    monkeypatch.setattr(gadget, "_mmap_arrays", True)
+    snap = pynbody.load(filename)
+    family_keys = (pynbody.family.dm, "pos"), (pynbody.family.star, "mass"), (pynbody.family.gas, "u")
+    arrays = [snap[fam][key] for fam, key in family_keys]
+    monkeypatch.setattr(gadget, "_mmap_arrays", False)
+    reference = pynbody.load(filename)
+    for array, (fam, key) in zip(arrays, family_keys):
+        assert _is_memory_mapped(array)
+        assert not _is_memory_mapped(reference[fam][key])
+        npt.assert_array_equal(array, reference[fam][key])
+
+
+def test_mmap_arrays_copy_on_write(tmp_path, monkeypatch):
+    """Check changes to memory-mapped arrays are not written back to the file"""
+    filename = str(tmp_path / "snap")
+    _make_gadget_snap(filename)
+    with open(filename, "rb") as f:
+        original_bytes = f.read()
+    monkeypatch.setattr(gadget, "_mmap_arrays", True)
+    snap = pynbody.load(filename)
+    original_pos = np.array(snap["pos"])
+    original_u = np.array(snap.gas["u"])
+    assert _is_memory_mapped(snap["pos"]) and _is_memory_mapped(snap.gas["u"])
+    snap["pos"] *= 2
+    snap.gas["u"][:] = -1
+    npt.assert_array_equal(snap["pos"], 2 * original_pos)
+    assert (snap.gas["u"] == -1).all()
+
+    with open(filename, "rb") as f:
+        assert f.read() == original_bytes
+    reloaded = pynbody.load(filename)
+    npt.assert_array_equal(reloaded["pos"], original_pos)
+    npt.assert_array_equal(reloaded.gas["u"], original_u)
+
+
+def _modify_and_write(filename):
+    snap = pynbody.load(filename)
+    snap["pos"] *= 2
+    snap.gas["u"] += 1
+    _ = snap["vel"]
+    snap.write()
+
+
+@pytest.mark.skipif(not hasattr(os, "pwritev"), reason="os.pwritev is not available on this platform")
+def test_write_short_pwritev(tmp_path, monkeypatch):
+    """Check files are written identically when the kernel accepts only part of each pwritev call"""
+    for subdir in "full", "short":
+        (tmp_path / subdir).mkdir()
+        _make_gadget_snap(str(tmp_path / subdir / "snap"), num_files=2)
+    _modify_and_write(str(tmp_path / "full" / "snap"))
+
+    pwritev = os.pwritev
+    n_calls = []
+
+    def short_pwritev(fd, buffers, offset):
+        # Write at most 7 bytes, which may end part way through the first or the second buffer
+        n_calls.append(1)
+        limited, remaining = [], 7
+        for b in buffers:
+            limited.append(memoryview(b).cast("B")[:remaining])
+            remaining -= len(limited[-1])
+            if remaining == 0:
+                break
+        return pwritev(fd, limited, offset)
+
+    monkeypatch.setattr(os, "pwritev", short_pwritev)
+    _modify_and_write(str(tmp_path / "short" / "snap"))
+    assert len(n_calls) > 0
+
+    for i in range(2):
+        with open(tmp_path / "full" / f"snap.{i}", "rb") as full, open(tmp_path / "short" / f"snap.{i}", "rb") as short:
+            assert full.read() == short.read()
+
+
+def test_write_in_place_batched(tmp_path, monkeypatch):
+    """Check an in-place write, which keeps a single handle open for each file throughout, can be read back"""
+    filename = str(tmp_path / "snap")
+    _make_gadget_snap(filename, num_files=2)
+    original = pynbody.load(filename)
+    pos, vel, u = np.array(original["pos"]), np.array(original["vel"]), np.array(original.gas["u"])
+
+    opened_for_writing = []
+
+    def recording_open(file, mode="r", *args, **kwargs):
+        if "+" in mode or "w" in mode:
+            opened_for_writing.append(file)
+        return open(file, mode, *args, **kwargs)
+
+    monkeypatch.setattr(gadget, "open", recording_open, raising=False)
+    _modify_and_write(filename)
+    assert sorted(opened_for_writing) == [filename + ".0", filename + ".1"]
+    monkeypatch.undo()
+
+    reloaded = pynbody.load(filename)
+    npt.assert_array_equal(reloaded["pos"], 2 * pos)
+    npt.assert_array_equal(reloaded["vel"], vel)
+    npt.assert_array_equal(reloaded.gas["u"], u + 1)
+    npt.assert_array_equal(reloaded["iord"], original["iord"])
@@ -0,0 +1,123 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+import scipy.integrate
+import scipy.ndimage
+
+import pynbody
+from pynbody.sph import _render, kernels, renderers
+
+
+@pytest.fixture(scope='module')
+def gas_snap():
+    n_part = 5000
+    rng = np.random.default_rng(1337)
+    snap = pynbody.new(gas=n_part)
+    snap['pos'] = rng.normal(size=(n_part, 3))
+    snap['pos'].units = 'kpc'
+    snap['mass'] = rng.uniform(0.5, 1.0, n_part)
+    snap['mass'].units = 'Msol'
+    snap['temp'] = rng.uniform(1e3, 1e5, n_part)
+    snap['temp'].units = 'K'
+    # trigger the kdtree-based smoothing lengths and densities up front, so that every render sees the same ones
+    _ = snap['smooth'], snap['rho']
+    return snap
+
+
+@pytest.mark.parametrize('options', [dict(threaded=False), dict(threaded=3),
+                                     dict(threaded=False, approximate_fast=True),
+                                     dict(threaded=2, approximate_fast=True)])
+@pytest.mark.parametrize('quantity', ['rho', 'temp'])
+def test_denoise_single_pass(gas_snap, options, quantity):
+    """Check the noise field rendered in the same particle loop as the image gives the same denoised image as
+    rendering it in a separate pass"""
+    renderer = renderers.make_render_pipeline(gas_snap, quantity=quantity, width=4.0, resolution=128,
+                                              denoise=True, **options)
+    assert isinstance(renderer, renderers.DenoisedImageRenderer)
+    assert renderer._subrenderers[0]._can_render_noise_field()
+
+    single_pass = renderer.render()
+    image, noise = renderers.MultipassImageRenderer.render(renderer)
+
+    npt.assert_allclose(single_pass, image / noise, rtol=1e-6)
+    assert single_pass.units == (image / noise).units
+
+
+@pytest.mark.parametrize(('source_shape', 'target_shape'), [((4, 4), (8, 8)), ((5, 5), (10, 10)), ((3, 3), (12, 12)),
+                                                           ((5, 7), (10, 14)), ((6, 3), (24, 12))])
+def test_add_upsampled_image(source_shape, target_shape):
+    """Check in-place upsampling of approximate-render levels matches the scipy zoom it replaces"""
+    rng = np.random.default_rng(42)
+    source = rng.uniform(size=source_shape).astype(np.float32)
+    target = rng.uniform(size=target_shape).astype(np.float32)
+    zoom = np.array(target_shape) / np.array(source_shape)
+    expected = target + scipy.ndimage.zoom(source, zoom, order=1, grid_mode=True, mode='grid-constant')
+
+    _render.add_upsampled_image(target, source)
+    npt.assert_allclose(target, expected, rtol=1e-5, atol=1e-6)
+
+
+def _scalar_cubic_spline(d, h=1):
+    if d < 1:
+        f = 1. - (3. / 2) * d ** 2 + (3. / 4.) * d ** 3
+    elif d < 2:
+        f = 0.25 * (2. - d) ** 3
+    else:
+        f = 0
+    return f / (np.pi * h ** 3)
+
+
+def _scalar_wendland_c2(d, h=1):
+    if d < 2:
+        f = (1. - (d / 2.)) ** 4 * (2. * d + 1)
+    else:
+        f = 0
+    return (21. * f) / (16. * np.pi * h ** 3)
+
+
+# Displacements including the origin, the integer radii where the kernels are only piecewise smooth, and either
+# side of the edge of the support
+_KERNEL_TEST_DISPLACEMENTS = np.concatenate((np.linspace(0, 2.5, 51), [1e-6, 1 - 1e-9, 1 + 1e-9, 2 - 1e-6, 2 + 1e-6]))
+
+
+@pytest.mark.parametrize(('kernel', 'scalar_kernel'), [(kernels.CubicSplineKernel(), _scalar_cubic_spline),
+                                                       (kernels.WendlandC2Kernel(), _scalar_wendland_c2)])
+@pytest.mark.parametrize('h', [1.0, 0.5])
+def test_kernel_values(kernel, scalar_kernel, h):
+    """Check the vectorised kernels against scalar evaluation of the same formulae"""
+    expected = [scalar_kernel(d, h) for d in _KERNEL_TEST_DISPLACEMENTS]
+    npt.assert_allclose(kernel.get_values(_KERNEL_TEST_DISPLACEMENTS, h), expected, rtol=1e-12, atol=1e-15)
+    npt.assert_allclose([kernel.get_value(d, h) for d in _KERNEL_TEST_DISPLACEMENTS], expected,
+                        rtol=1e-12, atol=1e-15)
+    assert np.shape(kernel.get_values(_KERNEL_TEST_DISPLACEMENTS.reshape(8, 7), h)) == (8, 7)
+
+
+@pytest.mark.parametrize(('kernel', 'scalar_kernel'), [(kernels.CubicSplineKernel(), _scalar_cubic_spline),
+                                                       (kernels.WendlandC2Kernel(), _scalar_wendland_c2)])
+@pytest.mark.parametrize('h', [1.0, 0.5])
+def test_kernel_projection(kernel, scalar_kernel, h):
+    """Check the fixed-order projection of 3D kernels agrees with adaptive quadrature"""
+    projected = kernel.projection()
+    def line_of_sight_integral(d):
+        # Break the integral wherever the line of sight crosses an integer radius inside the integration range
+        points = [np.sqrt(r ** 2 - d ** 2) for r in (1, 2) if d < r and np.sqrt(r ** 2 - d ** 2) < 2 * h]
+        return 2 * scipy.integrate.quad(lambda z: scalar_kernel(np.sqrt(z ** 2 + d ** 2), h), 0, 2 * h,
+                                        points=points or None, epsabs=1e-14, epsrel=1e-12)[0]
+
+    expected = [line_of_sight_integral(d) for d in _KERNEL_TEST_DISPLACEMENTS]
+    npt.assert_allclose(projected.get_values(_KERNEL_TEST_DISPLACEMENTS, h), expected, rtol=1e-8, atol=1e-12)
+    npt.assert_allclose([projected.get_value(d, h) for d in _KERNEL_TEST_DISPLACEMENTS], expected,
+                        rtol=1e-8, atol=1e-12)
+
+
+@pytest.mark.parametrize('kernel', [kernels.CubicSplineKernel(), kernels.WendlandC2Kernel(),
+                                    kernels.CubicSplineKernel().projection(), kernels.WendlandC2Kernel().projection()])
+def test_kernel_sample_dtype(kernel):
+    """Check kernel tables are cached separately for each precision, rather than a float32 table being reused"""
+    samples_32 = kernel.get_samples()
+    samples_64 = kernel.get_samples(np.float64)
+    assert samples_32.dtype == np.float32
+    assert samples_64.dtype == np.float64
+    assert kernel.get_samples(np.float64) is samples_64
+    npt.assert_allclose(samples_64, kernel.get_values(np.sqrt(np.arange(0, 4.01, 0.02))), rtol=1e-15)
+    npt.assert_allclose(samples_32, samples_64, rtol=1e-6)
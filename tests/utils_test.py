@@ -30,6 +30,10 @@ def test_thread_map_exception():
     assert exc.value.args[0] == "Test exception"
     assert exc.traceback[-1].name == 'testfn'
 
+def test_thread_map_nested():
+    result = pynbody.util.thread_map(lambda x: pynbody.util.thread_map(lambda y: x*y, range(3)), range(4))
+    assert result == [[0, 0, 0], [0, 1, 2], [0, 2, 4], [0, 3, 6]]
+
 def test_intersect_slices():
     """Unit test for intersect_slices, relative_slice and chained_slice"""
     from pynbody.util.indexing_tricks import intersect_slices